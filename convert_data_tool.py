@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# This file is part of MoralAI.
+#
+# MoralAI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MoralAI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MoralAI.  If not, see <https://www.gnu.org/licenses/>.
+import getopt
+import sys
+
+from manage_data import convert_data_file
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "", ["format="])
+    except getopt.GetoptError:
+        print("Usage: convert_data_tool.py [--format <npy|packed|jsonpickle>] <file_prefix>...")
+        sys.exit(2)
+
+    file_format = "npy"
+    for opt, arg in opts:
+        if opt == "--format":
+            file_format = arg
+
+    if len(args) == 0:
+        print("At least one file prefix required")
+        print("Usage: convert_data_tool.py [--format <npy|packed|jsonpickle>] <file_prefix>...")
+        sys.exit(2)
+
+    for name in args:
+        print("Converting " + name + " to " + file_format)
+        convert_data_file(name, file_format)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
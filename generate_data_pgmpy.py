@@ -12,12 +12,20 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with MoralAI.  If not, see <https://www.gnu.org/licenses/>.
+import hashlib
+import json
+import os
+import tempfile
+import unittest
+from collections import OrderedDict
 from random import choices
-from pgmpy.models import BayesianModel
-from pgmpy.factors.discrete import TabularCPD
-from pgmpy.inference import VariableElimination
+from unittest import mock
 
-from model import Dilemma, Person, Race, LegalSex
+import numpy as np
+
+from model import Dilemma, Person, Race, LegalSex, age_mapping, race_mapping, \
+    legal_sex_mapping, jaywalking_mapping, driving_under_the_influence_mapping, \
+    attribute_sizes, padding_index, compact_to_export
 
 
 class StatesAndProbs:
@@ -37,6 +45,184 @@ class StatesAndProbs:
         self.driving_under_the_influence_probability = driving_under_the_influence_probability
 
 
+# Compact index (see model.attribute_sizes) of each state in StatesAndProbs, in the same order as
+# the states.
+age_indices = np.array(
+    [age_mapping[Person(age=age).age].index(1) for age in StatesAndProbs.age_states])
+race_indices = np.array(
+    [race_mapping[race].index(1) for race in StatesAndProbs.race_states])
+legal_sex_indices = np.array(
+    [legal_sex_mapping[legal_sex].index(1) for legal_sex in StatesAndProbs.legal_sex_states])
+jaywalking_indices = np.array(
+    [jaywalking_mapping[jaywalking].index(1) for jaywalking in
+     StatesAndProbs.jaywalking_states])
+driving_under_the_influence_indices = np.array(
+    [driving_under_the_influence_mapping[dui].index(1) for dui in
+     StatesAndProbs.driving_under_the_influence_states])
+
+
+def sample_indices(rng, probability, indices, size):
+    """
+    Samples states by inverse transform sampling and returns the compact index of each sample.
+
+    :param rng: The numpy random Generator to draw from.
+    :param probability: The probability of each state.
+    :param indices: The compact index of each state.
+    :param size: The shape of the samples.
+    :return: An array of compact indices of the given shape.
+    """
+    cdf = np.cumsum(probability)
+    samples = np.searchsorted(cdf / cdf[-1], rng.random(size), side="right")
+    return indices[np.minimum(samples, len(indices) - 1)]
+
+
+def default_cache_dir():
+    """
+    :return: The directory caches are spilled to. This is $MORALAI_CACHE_DIR if it is set and
+    ~/.cache/moralai otherwise.
+    """
+    return os.environ.get("MORALAI_CACHE_DIR",
+                          os.path.join(os.path.expanduser("~"), ".cache", "moralai"))
+
+
+class ProbabilityCache:
+
+    def __init__(self, max_size: int = 256, directory: str = None):
+        """
+        A least recently used cache of DilemmaGenerator probability tables, keyed by a hash of the
+        CPDs they were computed from. Entries which fall out of memory are still kept on disk if
+        a directory is given, so other processes can reuse them too.
+
+        :param max_size: The maximum number of entries kept in memory.
+        :param directory: The directory entries are written to, or None to only cache in memory.
+        """
+        self.max_size = max_size
+        self.directory = directory
+        self.entries = OrderedDict()
+
+    # Part of every key, so entries computed by an older version of the probability tables are
+    # never reused from disk. Bump it whenever the way the tables are computed changes.
+    version = "v1"
+
+    @staticmethod
+    def key(*cpds) -> str:
+        """
+        :param cpds: The CPDs (and anything else) the probability tables depend on.
+        :return: The cache key for the CPDs.
+        """
+        encoded = json.dumps([ProbabilityCache.version] +
+                             [np.asarray(cpd, dtype=np.float64).tolist() for cpd in cpds])
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key: str):
+        """
+        :param key: The cache key.
+        :return: A tuple of the option probabilities and the list of StatesAndProbs, or None if
+        the key is not cached.
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        if self.directory is None:
+            return None
+
+        try:
+            with open(self.path(key), "r") as f:
+                obj = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        entry = (obj["option_probability"],
+                 [StatesAndProbs(**probabilities) for probabilities in obj["all_probabilities"]])
+        self.remember(key, entry)
+        return entry
+
+    def put(self, key: str, option_probability, all_probabilities):
+        """
+        Caches probability tables in memory and, if the directory can be written to, on disk.
+
+        :param key: The cache key.
+        :param option_probability: The probability of each option.
+        :param all_probabilities: The StatesAndProbs for each option.
+        """
+        entry = (option_probability, all_probabilities)
+        self.remember(key, entry)
+
+        if self.directory is None:
+            return
+
+        # The disk is only a second level, so an unwritable directory just leaves the entry in
+        # memory.
+        temp_path = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+
+            # Write to a temporary file first so concurrent readers never see a partial entry.
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump({
+                    "option_probability": [float(x) for x in option_probability],
+                    "all_probabilities": [{
+                        "age_probability": probs.age_probability,
+                        "race_probability": probs.race_probability,
+                        "legal_sex_probability": probs.legal_sex_probability,
+                        "jaywalking_probability": probs.jaywalking_probability,
+                        "driving_under_the_influence_probability":
+                            probs.driving_under_the_influence_probability
+                    } for probs in all_probabilities]
+                }, f)
+            os.replace(temp_path, self.path(key))
+        except OSError:
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def remember(self, key: str, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Forgets all entries held in memory. Entries on disk are kept.
+        """
+        self.entries.clear()
+
+
+probability_cache = ProbabilityCache(directory=os.path.join(default_cache_dir(), "probabilities"))
+
+
+def check_cpd(variable: str, values, variable_card: int, evidence_card: int = None):
+    """
+    Checks that a CPD has the right shape and that each of its distributions sums to 1.
+
+    :param variable: The name of the variable, used in error messages.
+    :param values: The CPD values.
+    :param variable_card: The cardinality of the variable.
+    :param evidence_card: The cardinality of the evidence, or None if the variable has no parents.
+    :return: The CPD values as an array of shape (variable_card, evidence_card), or
+    (1, variable_card) if the variable has no parents.
+    """
+    values = np.array(values, dtype=np.float64)
+    shape = (1, variable_card) if evidence_card is None else (variable_card, evidence_card)
+    if values.shape != shape:
+        raise ValueError("CPD for " + variable + " must be of shape " + str(shape) + ". Got shape: "
+                         + str(values.shape))
+
+    if np.any(values < 0):
+        raise ValueError("CPD for " + variable + " has negative values: " + str(values))
+
+    sums = values.sum(axis=1 if evidence_card is None else 0)
+    if not np.allclose(sums, 1, atol=0.01):
+        raise ValueError("Sum of probabilities of CPD for " + variable + " is not 1: " + str(sums))
+
+    return values
+
+
 def generate_cpd(variable_cardinality, evidence_cardinality):
     cpd = []
     for i in range(variable_cardinality):
@@ -59,7 +245,21 @@ class DilemmaGenerator:
     driving_under_the_influence_card = 2
 
     def __init__(self, option_vals, age_vals=None, race_vals=None, legal_sex_vals=None,
-                 jaywalking_vals=None, driving_under_the_influence_vals=None, debug=False):
+                 jaywalking_vals=None, driving_under_the_influence_vals=None, debug=False,
+                 full_model=False, cache=probability_cache):
+        """
+        Creates a generator for dilemmas modeled by a Bayesian network where option is the parent
+        of every attribute of a person. CPDs use the pgmpy layout: option_vals is a single row of
+        option probabilities and every other CPD has one row per state and one column per option.
+        Attribute CPDs which are not given are uniform.
+
+        :param option_vals: The option CPD.
+        :param debug: Whether to print the CPDs.
+        :param full_model: Whether to build the full pgmpy model and infer the probability tables
+        from it instead of reading them from the CPDs. This needs pgmpy installed.
+        :param cache: The ProbabilityCache to look the probability tables up in, or None to always
+        compute them. When the tables come from the cache, model and infer are None.
+        """
         self.option_card = len(option_vals[0])
         self.cpd_option_values = option_vals
 
@@ -92,6 +292,79 @@ class DilemmaGenerator:
             self.cpd_driving_under_the_influence_values = generate_cpd(
                 self.driving_under_the_influence_card, self.option_card)
 
+        key = None
+        if cache is not None and not debug:
+            key = ProbabilityCache.key(
+                [full_model], self.cpd_option_values, self.cpd_age_values,
+                self.cpd_race_values, self.cpd_legal_sex_values, self.cpd_jaywalking_values,
+                self.cpd_driving_under_the_influence_values
+            )
+
+            cached = cache.get(key)
+            if cached is not None:
+                self.model = None
+                self.infer = None
+                self.option_states = [i for i in range(self.option_card)]
+                self.option_probability, self.all_probabilities = cached
+                return
+
+        if full_model:
+            self.infer_probabilities(debug)
+        else:
+            self.compute_probabilities(debug)
+
+        if key is not None:
+            cache.put(key, self.option_probability, self.all_probabilities)
+
+    def compute_probabilities(self, debug=False):
+        """
+        Builds the probability tables directly from the CPDs. The network is a star where option is
+        the only parent of every attribute, so the marginal of option is its CPD and the
+        distribution of an attribute given an option is that option's column of the attribute's
+        CPD. No inference is needed.
+        """
+        self.model = None
+        self.infer = None
+
+        option_values = check_cpd(self.var_option, self.cpd_option_values, self.option_card)
+        attribute_values = [
+            check_cpd(variable, values, card, self.option_card) for variable, values, card in (
+                (self.var_age, self.cpd_age_values, self.age_card),
+                (self.var_race, self.cpd_race_values, self.race_card),
+                (self.var_legal_sex, self.cpd_legal_sex_values, self.legal_sex_card),
+                (self.var_jaywalking, self.cpd_jaywalking_values, self.jaywalking_card),
+                (self.var_driving_under_the_influence,
+                 self.cpd_driving_under_the_influence_values,
+                 self.driving_under_the_influence_card)
+            )
+        ]
+
+        if debug:
+            print("Option CPD:")
+            print(option_values)
+
+            for name, values in zip(["Age", "Race", "Legal sex", "Jaywalking",
+                                     "Driving under the influence"], attribute_values):
+                print(name + " CPD:")
+                print(values)
+
+        self.option_states = [i for i in range(self.option_card)]
+        self.option_probability = option_values[0].tolist()
+
+        self.all_probabilities = [
+            StatesAndProbs(*[values[:, option].tolist() for values in attribute_values])
+            for option in self.option_states
+        ]
+
+    def infer_probabilities(self, debug=False):
+        """
+        Builds the full pgmpy model and infers the probability tables from it. This needs pgmpy
+        installed.
+        """
+        from pgmpy.models import BayesianModel
+        from pgmpy.factors.discrete import TabularCPD
+        from pgmpy.inference import VariableElimination
+
         self.model = BayesianModel([
             (self.var_option, self.var_age),
             (self.var_option, self.var_race),
@@ -186,9 +459,10 @@ class DilemmaGenerator:
         # noinspection PyTypeChecker
         self.infer = VariableElimination(self.model)
 
+        self.option_states = [i for i in range(self.option_card)]
+
         option_query = self.infer.query(["option"])["option"].values
         self.option_probability = [option_query[i] for i in range(self.option_card)]
-        self.option_states = [i for i in range(self.option_card)]
 
         def generate_option_probabilities(option: int):
             def infer_values_given_option(variable: str):
@@ -216,6 +490,28 @@ class DilemmaGenerator:
         self.all_probabilities = [generate_option_probabilities(state) for state in
                                   self.option_states]
 
+    def mirror(self, **kwargs):
+        """
+        Creates the mirror of this generator: the generator with the options in reverse order.
+
+        :param kwargs: Extra arguments for the new generator's constructor.
+        :return: The mirrored generator.
+        """
+
+        def reverse_columns(values):
+            return [row[::-1] for row in np.asarray(values).tolist()]
+
+        return DilemmaGenerator(
+            option_vals=reverse_columns(self.cpd_option_values),
+            age_vals=reverse_columns(self.cpd_age_values),
+            race_vals=reverse_columns(self.cpd_race_values),
+            legal_sex_vals=reverse_columns(self.cpd_legal_sex_values),
+            jaywalking_vals=reverse_columns(self.cpd_jaywalking_values),
+            driving_under_the_influence_vals=reverse_columns(
+                self.cpd_driving_under_the_influence_values),
+            **kwargs
+        )
+
     def generate_person_list(self, option_size: int, option: int):
         age_choices = choices(self.all_probabilities[option].age_states,
                               self.all_probabilities[option].age_probability,
@@ -266,3 +562,185 @@ class DilemmaGenerator:
         label[option_sizes.index(max(option_sizes))] = 1
 
         return dilemma, label
+
+    def generate_dilemma_batch(self, n: int, max_num_people: int, rng=None, dtype=np.int64,
+                               compact: bool = False):
+        """
+        Generates n dilemmas directly in their exported form. The output has the same
+        distribution as calling generate_dilemma n times and exporting each dilemma, but it is
+        sampled and encoded with numpy instead of building Dilemma and Person objects.
+
+        :param n: The number of dilemmas to generate.
+        :param max_num_people: The maximum number of people in an option.
+        :param rng: The numpy random Generator to draw from. Defaults to a freshly seeded one.
+        :param dtype: The dtype of the returned arrays. Ignored if compact is True.
+        :param compact: Whether to return the data in the compact encoding (see
+        model.compact_to_export) instead of as bit vectors.
+        :return: A tuple of the data, shape (n, option_card * max_num_people * 22), or
+        (n, option_card, max_num_people, 5) of uint8 if compact is True, and the one-hot labels,
+        shape (n, option_card).
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+
+        option_probability = np.array(self.option_probability, dtype=np.float64)
+        option_sizes = rng.multinomial(max_num_people,
+                                       option_probability / option_probability.sum(), size=n)
+
+        data = np.full((n, self.option_card, max_num_people, len(attribute_sizes)),
+                       padding_index, dtype=np.uint8)
+
+        # People fill the first option_sizes[i, option] slots of each option, the rest is padding.
+        slots = np.arange(max_num_people)
+        for option in self.option_states:
+            probs = self.all_probabilities[option]
+            occupied = slots < option_sizes[:, option, np.newaxis]
+            rows, people = np.nonzero(occupied)
+            size = len(rows)
+
+            for attribute, (probability, indices) in enumerate((
+                    (probs.age_probability, age_indices),
+                    (probs.race_probability, race_indices),
+                    (probs.legal_sex_probability, legal_sex_indices),
+                    (probs.jaywalking_probability, jaywalking_indices),
+                    (probs.driving_under_the_influence_probability,
+                     driving_under_the_influence_indices))):
+                data[rows, option, people, attribute] = sample_indices(rng, probability, indices,
+                                                                       size)
+
+        # Label the leftmost maximum size option as correct.
+        labels = np.zeros((n, self.option_card), dtype=np.uint8 if compact else dtype)
+        labels[np.arange(n), np.argmax(option_sizes, axis=1)] = 1
+
+        if compact:
+            return data, labels
+
+        return compact_to_export(data, dtype=dtype).reshape(n, -1), labels
+
+
+class TestDilemmaGenerator(unittest.TestCase):
+
+    def testProbabilitiesFromCpds(self):
+        generator = DilemmaGenerator(
+            option_vals=[[0.4, 0.6]],
+            jaywalking_vals=[[0.2, 0.8], [0.8, 0.2]],
+            cache=None
+        )
+
+        self.assertEqual(generator.option_states, [0, 1])
+        self.assertEqual(generator.option_probability, [0.4, 0.6])
+        self.assertEqual(generator.all_probabilities[0].jaywalking_probability, [0.2, 0.8])
+        self.assertEqual(generator.all_probabilities[1].jaywalking_probability, [0.8, 0.2])
+        self.assertEqual(generator.all_probabilities[1].legal_sex_probability, [0.5, 0.5])
+
+    def testInvalidCpdShape(self):
+        with self.assertRaises(ValueError):
+            DilemmaGenerator(option_vals=[[0.5, 0.5]], jaywalking_vals=[[0.5, 0.5]], cache=None)
+
+    def testInvalidCpdSum(self):
+        with self.assertRaises(ValueError):
+            DilemmaGenerator(option_vals=[[0.5, 0.6]], cache=None)
+
+    def testGenerateDilemmaBatch(self):
+        generator = DilemmaGenerator(
+            option_vals=[[1.0, 0.0]],
+            jaywalking_vals=[[0.0, 1.0], [1.0, 0.0]],
+            cache=None
+        )
+
+        data, labels = generator.generate_dilemma_batch(4, 3, rng=np.random.default_rng(0))
+
+        self.assertEqual(data.shape, (4, 2 * 3 * 22))
+        self.assertEqual(labels.tolist(), [[1, 0]] * 4)
+
+        # Everyone is in the first option and everyone is jaywalking.
+        people = data.reshape(4, 2, 3, 22)
+        self.assertTrue(np.all(people[:, 0, :, 17] == 1))
+        self.assertTrue(np.all(people[:, 1] == 0))
+        self.assertTrue(np.all(people[:, 0].sum(axis=-1) == 5))
+
+    def testGenerateDilemmaBatchMatchesGenerateDilemma(self):
+        import random
+
+        generator = DilemmaGenerator(
+            option_vals=[[0.4, 0.6]],
+            jaywalking_vals=[[0.3, 0.7], [0.7, 0.3]],
+            cache=None
+        )
+        n = 4000
+
+        data, labels = generator.generate_dilemma_batch(n, 3, rng=np.random.default_rng(0))
+
+        random.seed(0)
+        dilemmas = [generator.generate_dilemma(3) for _ in range(n)]
+        other_data = np.stack([dilemma.export_as_array() for dilemma, _ in dilemmas])
+        other_labels = np.array([label for _, label in dilemmas])
+
+        # Both are samples of the same distribution, so they agree up to sampling error.
+        self.assertTrue(np.allclose(labels.mean(axis=0), other_labels.mean(axis=0), atol=0.03))
+
+        people = data.reshape(n, 2, 3, 22)
+        other_people = other_data.reshape(n, 2, 3, 22)
+        self.assertTrue(np.allclose(people.any(axis=-1).sum(axis=-1).mean(axis=0),
+                                    other_people.any(axis=-1).sum(axis=-1).mean(axis=0),
+                                    atol=0.06))
+        self.assertTrue(np.allclose(people.mean(axis=(0, 2)), other_people.mean(axis=(0, 2)),
+                                    atol=0.03))
+
+    def testMirror(self):
+        generator = DilemmaGenerator(
+            option_vals=[[0.4, 0.6]],
+            jaywalking_vals=[[0.2, 0.8], [0.8, 0.2]],
+            cache=None
+        )
+
+        mirror = generator.mirror(cache=None)
+
+        self.assertEqual(mirror.cpd_option_values, [[0.6, 0.4]])
+        self.assertEqual(mirror.cpd_jaywalking_values, [[0.8, 0.2], [0.2, 0.8]])
+        self.assertEqual(mirror.all_probabilities[0].jaywalking_probability,
+                         generator.all_probabilities[1].jaywalking_probability)
+
+
+class TestProbabilityCache(unittest.TestCase):
+
+    def testCachedProbabilitiesSpillToDisk(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ProbabilityCache(max_size=1, directory=directory)
+            first = DilemmaGenerator(option_vals=[[0.4, 0.6]], cache=cache)
+            DilemmaGenerator(option_vals=[[0.3, 0.7]], cache=cache)
+            self.assertEqual(len(cache.entries), 1)
+            self.assertEqual(len(os.listdir(directory)), 2)
+
+            # The first entry was evicted from memory, so this one must come from disk.
+            second = DilemmaGenerator(option_vals=[[0.4, 0.6]],
+                                      cache=ProbabilityCache(directory=directory))
+            self.assertIsNone(second.infer)
+            self.assertEqual(second.option_probability, first.option_probability)
+            self.assertEqual(second.all_probabilities[1].race_probability,
+                             first.all_probabilities[1].race_probability)
+
+    def testUnwritableDirectoryKeepsEntriesInMemory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # A directory below a regular file can never be created.
+            blocker = os.path.join(directory, "file")
+            open(blocker, "w").close()
+            cache = ProbabilityCache(directory=os.path.join(blocker, "probabilities"))
+
+            generator = DilemmaGenerator(option_vals=[[0.4, 0.6]], cache=cache)
+            self.assertEqual(len(cache.entries), 1)
+            self.assertTrue(os.path.isfile(blocker))
+            self.assertEqual(generator.option_probability, [0.4, 0.6])
+
+    def testKeyDependsOnCpds(self):
+        self.assertEqual(ProbabilityCache.key([[0.5, 0.5]]), ProbabilityCache.key([[0.5, 0.5]]))
+        self.assertNotEqual(ProbabilityCache.key([[0.4, 0.6]]), ProbabilityCache.key([[0.6, 0.4]]))
+
+    def testKeyDependsOnVersion(self):
+        key = ProbabilityCache.key([[0.5, 0.5]])
+        with mock.patch.object(ProbabilityCache, "version", "v0"):
+            self.assertNotEqual(ProbabilityCache.key([[0.5, 0.5]]), key)
+
+
+if __name__ == '__main__':
+    unittest.main()
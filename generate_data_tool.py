@@ -21,7 +21,9 @@ from generate_data_pgmpy import DilemmaGenerator
 from manage_data import write_data_to_file, TrainMetadata
 
 
-def generate_data_two_options(filename: str, option_cpd: List[float], jaywalking_cpd: List[float]):
+def generate_data_two_options(filename: str, option_cpd: List[float], jaywalking_cpd: List[float],
+                              seed: int = None, workers: int = 1, compact: bool = False,
+                              file_format: str = "jsonpickle", symmetric: bool = False):
     generators = [
         DilemmaGenerator(
             option_vals=[
@@ -31,24 +33,23 @@ def generate_data_two_options(filename: str, option_cpd: List[float], jaywalking
                 jaywalking_cpd,
                 jaywalking_cpd[::-1]
             ]
-        ),
-        DilemmaGenerator(
-            option_vals=[
-                option_cpd[::-1]
-            ],
-            jaywalking_vals=[
-                jaywalking_cpd[::-1],
-                jaywalking_cpd
-            ]
         )
     ]
 
-    write_data_to_file(TrainMetadata(50000, 10), generators, filename)
+    # The second generator is the mirror of the first. In symmetric mode its data is derived from
+    # the first generator instead.
+    if not symmetric:
+        generators.append(generators[0].mirror())
+
+    write_data_to_file(TrainMetadata(50000, 10), generators, filename, seed=seed,
+                       workers=workers, compact=compact, file_format=file_format,
+                       symmetric=symmetric)
 
 
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, "o:", ["ocpd=", "jcpd="])
+        opts, args = getopt.getopt(argv, "o:", ["ocpd=", "jcpd=", "seed=", "workers=",
+                                                "compact", "format=", "symmetric"])
     except getopt.GetoptError:
         print("Usage: train_ai.py -o <test_file_prefix>")
         sys.exit(2)
@@ -56,6 +57,11 @@ def main(argv):
     test_data_filename = None
     ocpd = None
     jcpd = None
+    seed = None
+    workers = 1
+    compact = False
+    file_format = "jsonpickle"
+    symmetric = False
     for opt, arg in opts:
         if opt == "-o":
             test_data_filename = arg
@@ -63,6 +69,16 @@ def main(argv):
             ocpd = float(arg)
         elif opt == "--jcpd":
             jcpd = float(arg)
+        elif opt == "--seed":
+            seed = int(arg)
+        elif opt == "--workers":
+            workers = int(arg)
+        elif opt == "--compact":
+            compact = True
+        elif opt == "--format":
+            file_format = arg
+        elif opt == "--symmetric":
+            symmetric = True
 
     if test_data_filename is None:
         print("-o argument required")
@@ -77,7 +93,9 @@ def main(argv):
         print("Usage: train_ai.py -o <test_file_prefix>")
         sys.exit(2)
 
-    generate_data_two_options(test_data_filename, [ocpd, 1 - ocpd], [jcpd, 1 - jcpd])
+    generate_data_two_options(test_data_filename, [ocpd, 1 - ocpd], [jcpd, 1 - jcpd], seed=seed,
+                              workers=workers, compact=compact, file_format=file_format,
+                              symmetric=symmetric)
 
 
 if __name__ == '__main__':
@@ -12,16 +12,389 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with MoralAI.  If not, see <https://www.gnu.org/licenses/>.
+import queue
+import threading
+import unittest
+from multiprocessing import Pool
+
 import numpy as np
 
+from model import compact_to_export, export_to_compact, attribute_sizes, padding_index
+
+# The number of dilemmas generated by each shard. This does not depend on the number of workers so
+# that the data generated for a seed is the same however many workers generate it.
+default_shard_size = 10000
+
 
 def generate_modeled_dilemmas(generator, max_num_people: int, num_dilemmas: int):
-    dilemmas = [generator.generate_dilemma(max_num_people) for _ in range(num_dilemmas)]
-    return list(map(lambda x: (x[0].export_as_list(), x[1]), dilemmas))
+    """
+    Generates dilemmas one Dilemma at a time and exports them. generate_training_data is much
+    faster and produces the same distribution.
+
+    :return: A tuple of the exported dilemmas and their labels.
+    """
+    data = np.empty((num_dilemmas, generator.option_card * max_num_people * 22), dtype=np.int64)
+    labels = np.empty((num_dilemmas, generator.option_card), dtype=np.int64)
+    for i in range(num_dilemmas):
+        dilemma, label = generator.generate_dilemma(max_num_people)
+        dilemma.export_into(data[i])
+        labels[i] = label
+    return data, labels
+
+
+def generate_training_data(generator, max_num_people: int, num_dilemmas: int, rng=None,
+                           compact: bool = False):
+    return generator.generate_dilemma_batch(num_dilemmas, max_num_people, rng=rng,
+                                            compact=compact)
+
+
+def mirror_training_data(data, labels):
+    """
+    Mirrors dilemmas by reversing the order of their options. Mirroring dilemmas drawn from a
+    generator gives dilemmas distributed like ones drawn from the generator's mirror (see
+    DilemmaGenerator.mirror).
+
+    :param data: The data, as bit vectors or in the compact encoding.
+    :param labels: The labels.
+    :return: A tuple of the mirrored data and labels.
+    """
+    num_dilemmas, num_options = labels.shape
+
+    if data.ndim == 4:
+        mirrored = data[:, ::-1]
+        num_people = np.count_nonzero(mirrored[..., 0] != padding_index, axis=-1)
+    else:
+        mirrored = data.reshape(num_dilemmas, num_options, -1)[:, ::-1]
+        num_people = np.count_nonzero(
+            mirrored.reshape(num_dilemmas, num_options, -1, sum(attribute_sizes)).any(axis=-1),
+            axis=-1)
+        mirrored = mirrored.reshape(num_dilemmas, -1)
+
+    # Ties go to the leftmost option, so the labels can't just be reversed.
+    mirrored_labels = np.zeros_like(labels)
+    mirrored_labels[np.arange(num_dilemmas), np.argmax(num_people, axis=1)] = 1
+
+    return np.ascontiguousarray(mirrored), mirrored_labels
+
+
+def generate_shard(args):
+    generator, max_num_people, num_dilemmas, seed_sequence, compact, mirror = args
+    data, labels = generate_training_data(generator, max_num_people, num_dilemmas,
+                                          rng=np.random.default_rng(seed_sequence),
+                                          compact=compact)
+    if mirror:
+        return mirror_training_data(data, labels)
+    return data, labels
+
+
+def iterate_sharded_training_data(generators, max_num_people: int, num_dilemmas: int,
+                                  seed: int = None, workers: int = 1,
+                                  shard_size: int = default_shard_size, compact: bool = False,
+                                  symmetric: bool = False):
+    """
+    Generates num_dilemmas dilemmas from each generator, split into shards of shard_size dilemmas
+    which are generated across a pool of processes. Every shard draws from its own random stream
+    derived from the seed and the shard's position, so the result only depends on the seed and not
+    on the number of workers.
+
+    :param generators: The generators to generate data from, in order.
+    :param max_num_people: The maximum number of people in an option.
+    :param num_dilemmas: The number of dilemmas to generate from each generator.
+    :param seed: The seed, or None to seed from fresh entropy.
+    :param workers: The number of processes to generate shards in. 1 generates in this process.
+    :param shard_size: The number of dilemmas in each shard.
+    :param compact: Whether to generate the data in the compact encoding.
+    :param symmetric: Whether to follow each generator with its mirror (see
+    DilemmaGenerator.mirror) without building the mirror. The mirror's data is a second draw from
+    the generator with its options reversed.
+    :return: An iterator of tuples of the data and labels of each shard, in order.
+    """
+    entropy = np.random.SeedSequence(seed).entropy
+
+    if symmetric:
+        generators = [(generator, mirror) for generator in generators for mirror in (False, True)]
+    else:
+        generators = [(generator, False) for generator in generators]
+
+    shards = []
+    for generator_index, (generator, mirror) in enumerate(generators):
+        for shard_index, start in enumerate(range(0, num_dilemmas, shard_size)):
+            shards.append((
+                generator,
+                max_num_people,
+                min(shard_size, num_dilemmas - start),
+                np.random.SeedSequence(entropy, spawn_key=(generator_index, shard_index)),
+                compact,
+                mirror
+            ))
+
+    if workers == 1 or len(shards) <= 1:
+        yield from map(generate_shard, shards)
+    else:
+        with Pool(workers) as pool:
+            yield from pool.imap(generate_shard, shards)
+
+
+def generate_sharded_training_data(generators, max_num_people: int, num_dilemmas: int,
+                                   seed: int = None, workers: int = 1,
+                                   shard_size: int = default_shard_size, compact: bool = False,
+                                   symmetric: bool = False):
+    """
+    Generates the shards of iterate_sharded_training_data into one array.
+
+    :return: A tuple of the data and labels of all generators, concatenated in order.
+    """
+    data = None
+    labels = None
+    row = 0
+
+    for shard_data, shard_labels in iterate_sharded_training_data(
+            generators, max_num_people, num_dilemmas, seed=seed, workers=workers,
+            shard_size=shard_size, compact=compact, symmetric=symmetric):
+        # Write every shard straight into its rows of the output instead of concatenating.
+        if data is None:
+            num_rows = len(generators) * num_dilemmas * (2 if symmetric else 1)
+            data = np.empty((num_rows,) + shard_data.shape[1:], dtype=shard_data.dtype)
+            labels = np.empty((num_rows, shard_labels.shape[1]), dtype=shard_labels.dtype)
+
+        data[row:row + len(shard_data)] = shard_data
+        labels[row:row + len(shard_labels)] = shard_labels
+        row += len(shard_data)
+
+    return data, labels
+
+
+class TrainingDataStream:
+
+    def __init__(self, generators, max_num_people: int, num_dilemmas: int, batch_size: int = 32,
+                 seed=None, prefetch: int = 8, batches_per_chunk: int = 64):
+        """
+        An endless stream of freshly generated training batches, meant to be passed to
+        fit_generator instead of materializing the training set. Batches are generated in a
+        background thread which keeps up to prefetch batches ready. Each batch mixes the generators
+        equally, like the concatenated training set does once it is shuffled.
+
+        :param generators: The generators to generate data from.
+        :param max_num_people: The maximum number of people in an option.
+        :param num_dilemmas: The number of dilemmas per generator in an epoch. This only sets
+        steps_per_epoch.
+        :param batch_size: The number of dilemmas in each batch.
+        :param seed: The seed (an int or a numpy SeedSequence), or None to seed from fresh entropy.
+        The same seed always produces the same batches.
+        :param prefetch: The maximum number of batches generated ahead of the consumer.
+        :param batches_per_chunk: The number of batches generated at once.
+        """
+        self.generators = generators
+        self.max_num_people = max_num_people
+        self.batch_size = batch_size
+        self.batches_per_chunk = batches_per_chunk
+        self.steps_per_epoch = max(1, len(generators) * num_dilemmas // batch_size)
+
+        self.rng = np.random.default_rng(seed)
+        self.batches = queue.Queue(maxsize=max(1, prefetch))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.produce, daemon=True)
+        self.thread.start()
+
+    def generate_chunk(self):
+        chunk_size = self.batch_size * self.batches_per_chunk
+        sizes = [len(x) for x in np.array_split(np.arange(chunk_size), len(self.generators))]
+
+        data, labels = zip(*[
+            generate_training_data(generator, self.max_num_people, size, rng=self.rng)
+            for generator, size in zip(self.generators, sizes)
+        ])
+
+        order = self.rng.permutation(chunk_size)
+        return np.concatenate(data)[order], np.concatenate(labels)[order]
+
+    def offer(self, item):
+        """
+        Puts an item in the queue, waiting for room until the stream is closed.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce(self):
+        try:
+            while not self.stopped.is_set():
+                data, labels = self.generate_chunk()
+                for start in range(0, len(data), self.batch_size):
+                    self.offer((data[start:start + self.batch_size],
+                                labels[start:start + self.batch_size]))
+        except Exception as e:
+            # Hand the error to the consumer instead of letting it block forever.
+            self.offer(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = self.batches.get()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def close(self):
+        """
+        Stops the background thread.
+        """
+        self.stopped.set()
+        self.thread.join()
+
+
+class CompactDataFeed:
+
+    def __init__(self, data, labels, batch_size: int = 32, seed=None, dtype=np.float32):
+        """
+        An endless stream of shuffled batches of compactly encoded training data (see
+        model.compact_to_export), meant to be passed to fit_generator. Only one batch at a time is
+        expanded to bit vectors.
+
+        :param data: The compact data, shape (n, options, max_size, 5).
+        :param labels: The labels.
+        :param batch_size: The number of dilemmas in each batch.
+        :param seed: The seed for shuffling, or None to seed from fresh entropy.
+        :param dtype: The dtype of the expanded batches.
+        """
+        self.data = data
+        self.labels = labels
+        self.batch_size = batch_size
+        self.dtype = dtype
+        self.steps_per_epoch = -(-len(data) // batch_size)
+        self.rng = np.random.default_rng(seed)
+        self.batches = self.generate_batches()
+
+    def generate_batches(self):
+        while True:
+            order = self.rng.permutation(len(self.data))
+            for start in range(0, len(order), self.batch_size):
+                # Sorted indices keep the reads from the data sequential.
+                rows = np.sort(order[start:start + self.batch_size])
+                yield (compact_to_export(self.data[rows], dtype=self.dtype).reshape(len(rows), -1),
+                       self.labels[rows])
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.batches)
+
+    def close(self):
+        pass
+
+
+class TestShardedTrainingData(unittest.TestCase):
+
+    def testSameDataForAnyNumberOfWorkers(self):
+        from generate_data_pgmpy import DilemmaGenerator
+
+        generators = [DilemmaGenerator(option_vals=[[0.4, 0.6]], cache=None),
+                      DilemmaGenerator(option_vals=[[0.6, 0.4]], cache=None)]
+
+        data, labels = generate_sharded_training_data(generators, 3, 25, seed=1, shard_size=10)
+        parallel_data, parallel_labels = generate_sharded_training_data(generators, 3, 25, seed=1,
+                                                                        workers=2, shard_size=10)
+
+        self.assertEqual(data.shape, (50, 2 * 3 * 22))
+        self.assertEqual(labels.shape, (50, 2))
+        self.assertTrue(np.array_equal(data, parallel_data))
+        self.assertTrue(np.array_equal(labels, parallel_labels))
+
+    def testCompactDataMatchesExport(self):
+        from generate_data_pgmpy import DilemmaGenerator
+
+        generators = [DilemmaGenerator(option_vals=[[0.4, 0.6]], cache=None)]
+
+        data, labels = generate_sharded_training_data(generators, 3, 25, seed=1)
+        compact_data, compact_labels = generate_sharded_training_data(generators, 3, 25, seed=1,
+                                                                      compact=True)
+
+        self.assertEqual(compact_data.shape, (25, 2, 3, 5))
+        self.assertEqual(compact_data.dtype, np.uint8)
+        self.assertTrue(np.array_equal(compact_to_export(compact_data).reshape(25, -1), data))
+        self.assertTrue(np.array_equal(compact_labels, labels))
+
+    def testMirrorTrainingData(self):
+        data = np.zeros((2, 2 * 2 * 22), dtype=np.int64)
+        data[0, 0] = data[0, 22] = data[0, 44] = 1
+        data[1, 0] = data[1, 44] = 1
+        labels = np.array([[1, 0], [1, 0]])
+
+        mirrored_data, mirrored_labels = mirror_training_data(data, labels)
+
+        self.assertEqual(mirrored_data[0].tolist(), data[0, 44:].tolist() + data[0, :44].tolist())
+        self.assertEqual(mirrored_labels.tolist(), [[0, 1], [1, 0]])
+
+        compact = export_to_compact(data, 2, 2)
+        mirrored_compact, mirrored_compact_labels = mirror_training_data(compact, labels)
+        self.assertEqual(compact_to_export(mirrored_compact).reshape(2, -1).tolist(),
+                         mirrored_data.tolist())
+        self.assertEqual(mirrored_compact_labels.tolist(), mirrored_labels.tolist())
+
+    def testSymmetricDataIsMirrored(self):
+        from generate_data_pgmpy import DilemmaGenerator
+
+        generator = DilemmaGenerator(option_vals=[[1.0, 0.0]], cache=None)
+
+        data, labels = generate_sharded_training_data([generator], 3, 5, seed=1, symmetric=True)
+
+        self.assertEqual(data.shape, (10, 2 * 3 * 22))
+        self.assertEqual(labels.tolist(), [[1, 0]] * 5 + [[0, 1]] * 5)
+        self.assertTrue(np.all(data[:5, 3 * 22:] == 0))
+        self.assertTrue(np.all(data[5:, :3 * 22] == 0))
+
+
+class TestTrainingDataStream(unittest.TestCase):
+
+    def testSameBatchesForSameSeed(self):
+        from generate_data_pgmpy import DilemmaGenerator
+
+        generators = [DilemmaGenerator(option_vals=[[0.4, 0.6]], cache=None),
+                      DilemmaGenerator(option_vals=[[0.6, 0.4]], cache=None)]
+
+        streams = [TrainingDataStream(generators, 3, 100, batch_size=8, seed=1, prefetch=2,
+                                      batches_per_chunk=2) for _ in range(2)]
+        batches = [[next(stream) for _ in range(5)] for stream in streams]
+        for stream in streams:
+            stream.close()
+
+        self.assertEqual(streams[0].steps_per_epoch, 25)
+        for (data, labels), (other_data, other_labels) in zip(*batches):
+            self.assertEqual(data.shape, (8, 2 * 3 * 22))
+            self.assertEqual(labels.shape, (8, 2))
+            self.assertTrue(np.array_equal(data, other_data))
+            self.assertTrue(np.array_equal(labels, other_labels))
+
+    def testCloseAfterFailureWithFullQueue(self):
+        from generate_data_pgmpy import DilemmaGenerator
+
+        failed = threading.Event()
+
+        class FailingStream(TrainingDataStream):
+            chunks = 0
+
+            def generate_chunk(self):
+                # The first chunk fills the queue, the second fails.
+                self.chunks += 1
+                if self.chunks > 1:
+                    failed.set()
+                    raise ValueError("generation failed")
+                return super().generate_chunk()
+
+        generators = [DilemmaGenerator(option_vals=[[0.4, 0.6]], cache=None)]
+        stream = FailingStream(generators, 3, 100, batch_size=8, seed=1, prefetch=1,
+                               batches_per_chunk=1)
+        self.assertTrue(failed.wait(5))
+
+        stream.stopped.set()
+        stream.thread.join(5)
+        self.assertFalse(stream.thread.is_alive())
 
 
-def generate_training_data(generator, max_num_people: int, num_dilemmas: int):
-    data_and_labels = generate_modeled_dilemmas(generator, max_num_people, num_dilemmas)
-    data = [np.array(x[0]) for x in data_and_labels]
-    labels = [np.array(x[1]) for x in data_and_labels]
-    return np.array(data), np.array(labels)
+if __name__ == '__main__':
+    unittest.main()
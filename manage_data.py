@@ -12,10 +12,35 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with MoralAI.  If not, see <https://www.gnu.org/licenses/>.
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+from multiprocessing import shared_memory
+from unittest import mock
+
 import jsonpickle
 import numpy as np
 
-from generate_training_data import generate_training_data
+from generate_data_pgmpy import default_cache_dir
+from generate_training_data import generate_sharded_training_data, iterate_sharded_training_data
+from model import compact_to_export, attribute_sizes
+
+# Packed files start with packed_magic followed by a packed_header and then the rows of the array,
+# each packed to bits with np.packbits and padded to a whole number of bytes.
+packed_magic = b"MORALPKD"
+packed_header = np.dtype([("rows", "<u8"), ("options", "<u8"), ("max_size", "<u8"),
+                          ("width", "<u8")])
+packed_data_offset = len(packed_magic) + packed_header.itemsize
+
+# Chunked files start with chunked_magic, the length of the JSON header as a little endian uint64
+# and the JSON header. Then come the chunks, each the rows of its data followed by the rows of its
+# labels, and then the JSON chunk index. The file ends with the offset of the chunk index as a
+# little endian uint64.
+chunked_magic = b"MORALCHK"
 
 
 class TrainMetadata:
@@ -25,52 +50,958 @@ class TrainMetadata:
         self.max_num_people_per_option = max_num_people_per_option
 
 
-def preprocess_data_before_saving(metadata: TrainMetadata, generators):
-    data_tuples = [
-        generate_training_data(generator,
-                               metadata.max_num_people_per_option,
-                               metadata.train_data_size)
-        for generator in generators
-    ]
+def preprocess_data_before_saving(metadata: TrainMetadata, generators, seed: int = None,
+                                  workers: int = 1, compact: bool = False,
+                                  symmetric: bool = False):
+    return generate_sharded_training_data(generators,
+                                          metadata.max_num_people_per_option,
+                                          metadata.train_data_size,
+                                          seed=seed,
+                                          workers=workers,
+                                          compact=compact,
+                                          symmetric=symmetric)
+
+
+def write_packed_file(filename: str, array, num_options: int, max_size: int,
+                      chunk_size: int = 65536):
+    """
+    Writes a 2D array of bits to a packed file.
+
+    :param filename: The file to write.
+    :param array: The array. Every nonzero element is written as a 1.
+    :param num_options: The number of options in each dilemma, recorded in the header.
+    :param max_size: The maximum number of people in an option, recorded in the header.
+    :param chunk_size: The number of rows packed at once.
+    """
+    header = np.array((len(array), num_options, max_size, array.shape[1]), dtype=packed_header)
+    with open(filename, "wb") as f:
+        f.write(packed_magic)
+        f.write(header.tobytes())
+        for start in range(0, len(array), chunk_size):
+            f.write(np.packbits(array[start:start + chunk_size] != 0, axis=1).tobytes())
+
+
+def is_packed_file(filename: str) -> bool:
+    with open(filename, "rb") as f:
+        return f.read(len(packed_magic)) == packed_magic
+
+
+def read_packed_header(filename: str):
+    """
+    :param filename: The packed file.
+    :return: A tuple of the number of rows, the number of options, the maximum number of people in
+    an option, and the width of each row in bits.
+    """
+    with open(filename, "rb") as f:
+        if f.read(len(packed_magic)) != packed_magic:
+            raise ValueError("Not a packed file: " + filename)
+        header = np.frombuffer(f.read(packed_header.itemsize), dtype=packed_header)[0]
+    return tuple(int(x) for x in header)
+
+
+def read_packed_file(filename: str, start: int = 0, stop: int = None, dtype=np.uint8):
+    """
+    Reads rows from a packed file. Only the requested rows are read from disk.
+
+    :param filename: The packed file.
+    :param start: The first row to read.
+    :param stop: The row to stop reading at, or None to read to the end.
+    :param dtype: The dtype of the returned array.
+    :return: The rows, shape (stop - start, width).
+    """
+    rows, _, _, width = read_packed_header(filename)
+    stop = rows if stop is None else min(stop, rows)
+    start = min(start, stop)
+    row_bytes = -(-width // 8)
+
+    with open(filename, "rb") as f:
+        f.seek(packed_data_offset + start * row_bytes)
+        packed = np.fromfile(f, dtype=np.uint8, count=(stop - start) * row_bytes)
+
+    return np.unpackbits(packed.reshape(-1, row_bytes), axis=1, count=width).astype(dtype,
+                                                                                   copy=False)
+
+
+class ChunkedDatasetWriter:
+
+    def __init__(self, filename: str, metadata: TrainMetadata, row_shape, num_options: int,
+                 chunk_size: int = 10000, num_rows: int = None):
+        """
+        Writes a chunked dataset file. Rows are buffered until a chunk is full, so memory use is
+        bounded by the chunk size however many rows are appended. The rows are written to a
+        temporary file which is only renamed to the filename once the writer is closed, so an
+        interrupted write never leaves a file which looks complete. Used as a context manager, the
+        writer is aborted instead of closed if an exception is raised.
+
+        :param filename: The file to write.
+        :param metadata: The metadata to store in the header.
+        :param row_shape: The shape of a row of data, (options * max_size * 22,) for bit vectors or
+        (options, max_size, 5) for the compact encoding.
+        :param num_options: The number of options, which is the width of the labels.
+        :param chunk_size: The number of rows in each chunk.
+        :param num_rows: The number of rows which will be appended, or None if it is not known.
+        It is recorded in the header, and closing the writer fails unless exactly this many rows
+        were appended.
+        """
+        self.filename = filename
+        self.temp_filename = filename + ".tmp"
+        self.num_rows = num_rows
+        self.appended_rows = 0
+        self.row_shape = tuple(row_shape)
+        self.num_options = num_options
+        self.chunk_size = chunk_size
+        self.index = []
+        self.data_buffer = []
+        self.labels_buffer = []
+        self.buffered_rows = 0
+
+        header = json.dumps({
+            "train_data_size": metadata.train_data_size,
+            "max_num_people_per_option": metadata.max_num_people_per_option,
+            "row_shape": self.row_shape,
+            "num_options": num_options,
+            "chunk_size": chunk_size,
+            "num_rows": num_rows
+        }).encode()
+
+        self.file = open(self.temp_filename, "wb")
+        self.file.write(chunked_magic)
+        self.file.write(np.uint64(len(header)).astype("<u8").tobytes())
+        self.file.write(header)
+
+    def append(self, data, labels):
+        """
+        Appends rows to the dataset.
+
+        :param data: The data, shape (n,) + row_shape. Stored as uint8.
+        :param labels: The labels, shape (n, num_options). Stored as uint8.
+        """
+        self.data_buffer.append(np.asarray(data, dtype=np.uint8))
+        self.labels_buffer.append(np.asarray(labels, dtype=np.uint8))
+        self.buffered_rows += len(data)
+        self.appended_rows += len(data)
+
+        if self.buffered_rows >= self.chunk_size:
+            data = np.concatenate(self.data_buffer)
+            labels = np.concatenate(self.labels_buffer)
+            full = len(data) - len(data) % self.chunk_size
+            for start in range(0, full, self.chunk_size):
+                self.write_chunk(data[start:start + self.chunk_size],
+                                 labels[start:start + self.chunk_size])
+
+            self.data_buffer = [data[full:]]
+            self.labels_buffer = [labels[full:]]
+            self.buffered_rows = len(data) - full
+
+    def write_chunk(self, data, labels):
+        if data.shape[1:] != self.row_shape or labels.shape[1:] != (self.num_options,):
+            raise ValueError("Rows of shape " + str(data.shape[1:]) + " and labels of shape " +
+                             str(labels.shape[1:]) + " do not match the dataset")
+
+        self.index.append([self.file.tell(), len(data)])
+        self.file.write(np.ascontiguousarray(data).tobytes())
+        self.file.write(np.ascontiguousarray(labels).tobytes())
+
+    def close(self):
+        """
+        Writes the remaining rows and the chunk index and moves the file into place.
+        """
+        if self.file.closed:
+            return
+
+        if self.num_rows is not None and self.appended_rows != self.num_rows:
+            self.abort()
+            raise ValueError(str(self.appended_rows) + " rows were appended to " + self.filename +
+                             " instead of " + str(self.num_rows))
+
+        if self.buffered_rows > 0:
+            self.write_chunk(np.concatenate(self.data_buffer), np.concatenate(self.labels_buffer))
+            self.data_buffer = []
+            self.labels_buffer = []
+            self.buffered_rows = 0
+
+        index_offset = self.file.tell()
+        self.file.write(json.dumps(self.index).encode())
+        self.file.write(np.uint64(index_offset).astype("<u8").tobytes())
+        self.file.close()
+        os.replace(self.temp_filename, self.filename)
+
+    def abort(self):
+        """
+        Discards everything written so far.
+        """
+        if self.file.closed:
+            return
+
+        self.file.close()
+        os.remove(self.temp_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ChunkedDatasetReader:
+
+    def __init__(self, filename: str):
+        """
+        Reads a chunked dataset file written by ChunkedDatasetWriter. Only the header and the chunk
+        index are read up front. Rows are read from disk as they are requested.
+
+        :param filename: The file to read.
+        """
+        self.filename = filename
+
+        with open(filename, "rb") as f:
+            if f.read(len(chunked_magic)) != chunked_magic:
+                raise ValueError("Not a chunked dataset file: " + filename)
+
+            header_length = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+            header = json.loads(f.read(header_length).decode())
+
+            f.seek(-8, os.SEEK_END)
+            index_offset = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+            f.seek(index_offset)
+            self.index = json.loads(f.read(os.path.getsize(filename) - 8 - index_offset).decode())
+
+        self.metadata = TrainMetadata(header["train_data_size"],
+                                      header["max_num_people_per_option"])
+        self.row_shape = tuple(header["row_shape"])
+        self.num_options = header["num_options"]
+        self.row_bytes = int(np.prod(self.row_shape))
+
+        # The first row of each chunk, with the total number of rows at the end.
+        self.chunk_starts = np.cumsum([0] + [rows for _, rows in self.index])
 
-    data = []
-    for item in [x[0] for x in data_tuples]:
-        [data.append(x) for x in item]
+        num_rows = header.get("num_rows")
+        if num_rows is not None and self.chunk_starts[-1] != num_rows:
+            raise ValueError(filename + " holds " + str(self.chunk_starts[-1]) +
+                             " rows instead of " + str(num_rows))
 
-    labels = []
-    for item in [x[1] for x in data_tuples]:
-        [labels.append(x) for x in item]
+    def __len__(self):
+        return int(self.chunk_starts[-1])
 
-    return np.array(data), np.array(labels)
+    def read_chunk(self, f, chunk: int, start: int = 0, stop: int = None):
+        """
+        Reads rows start to stop of a chunk from an open file.
+        """
+        offset, rows = self.index[chunk]
+        stop = rows if stop is None else stop
 
+        f.seek(offset + start * self.row_bytes)
+        data = np.fromfile(f, dtype=np.uint8, count=(stop - start) * self.row_bytes)
 
-def write_data_to_file(metadata: TrainMetadata, generators, name: str):
-    data, labels = preprocess_data_before_saving(metadata, generators)
+        f.seek(offset + rows * self.row_bytes + start * self.num_options)
+        labels = np.fromfile(f, dtype=np.uint8, count=(stop - start) * self.num_options)
 
-    data_file = open(name + "_data", "w")
-    data_file.write(jsonpickle.encode(data))
-    data_file.close()
+        return data.reshape((-1,) + self.row_shape), labels.reshape(-1, self.num_options)
 
-    labels_file = open(name + "_labels", "w")
-    labels_file.write(jsonpickle.encode(labels))
-    labels_file.close()
+    def chunks(self):
+        """
+        :return: An iterator of tuples of the data and labels of each chunk, in order.
+        """
+        with open(self.filename, "rb") as f:
+            for chunk in range(len(self.index)):
+                yield self.read_chunk(f, chunk)
+
+    def read(self, start: int = 0, stop: int = None):
+        """
+        Reads a range of rows. Only the chunks which overlap the range are read.
+
+        :param start: The first row to read.
+        :param stop: The row to stop reading at, or None to read to the end.
+        :return: A tuple of the data and labels of the rows.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        start = min(start, stop)
+
+        data = np.empty((stop - start,) + self.row_shape, dtype=np.uint8)
+        labels = np.empty((stop - start, self.num_options), dtype=np.uint8)
+
+        first_chunk = int(np.searchsorted(self.chunk_starts, start, side="right")) - 1
+        with open(self.filename, "rb") as f:
+            for chunk in range(max(first_chunk, 0), len(self.index)):
+                chunk_start = int(self.chunk_starts[chunk])
+                if chunk_start >= stop:
+                    break
+
+                row_start = max(start, chunk_start)
+                row_stop = min(stop, int(self.chunk_starts[chunk + 1]))
+                chunk_data, chunk_labels = self.read_chunk(f, chunk, row_start - chunk_start,
+                                                           row_stop - chunk_start)
+                data[row_start - start:row_stop - start] = chunk_data
+                labels[row_start - start:row_stop - start] = chunk_labels
+
+        return data, labels
+
+
+def save_data(name: str, data, labels, metadata: TrainMetadata, file_format: str = "jsonpickle"):
+    """
+    Saves data, labels and metadata under a name.
+
+    :param name: The prefix of the files to write.
+    :param file_format: "jsonpickle" to write jsonpickle text, "packed" to write packed files (see
+    write_packed_file), or "npy" to write .npy files with a JSON metadata sidecar which
+    read_data_from_file memory maps.
+    """
+    if file_format == "npy":
+        # All data is bits or compact indices, so it fits in a byte.
+        np.save(name + "_data.npy", np.asarray(data, dtype=np.uint8))
+        np.save(name + "_labels.npy", np.asarray(labels, dtype=np.uint8))
+
+        with open(name + "_metadata.json", "w") as f:
+            json.dump({
+                "train_data_size": metadata.train_data_size,
+                "max_num_people_per_option": metadata.max_num_people_per_option,
+                "num_options": labels.shape[1]
+            }, f)
+        return
+
+    if file_format == "packed":
+        if data.ndim == 4:
+            data = compact_to_export(data).reshape(len(data), -1)
+
+        num_options = labels.shape[1]
+        write_packed_file(name + "_data", data, num_options, metadata.max_num_people_per_option)
+        write_packed_file(name + "_labels", labels, num_options,
+                          metadata.max_num_people_per_option)
+    elif file_format == "jsonpickle":
+        data_file = open(name + "_data", "w")
+        data_file.write(jsonpickle.encode(data))
+        data_file.close()
+
+        labels_file = open(name + "_labels", "w")
+        labels_file.write(jsonpickle.encode(labels))
+        labels_file.close()
+    else:
+        raise ValueError("Unknown file format: " + file_format)
 
     metadata_file = open(name + "_metadata", "w")
     metadata_file.write(jsonpickle.encode(metadata))
     metadata_file.close()
 
 
+def write_data_to_file(metadata: TrainMetadata, generators, name: str, seed: int = None,
+                       workers: int = 1, compact: bool = False, file_format: str = "jsonpickle",
+                       symmetric: bool = False):
+    """
+    Generates data and saves it under a name (see save_data).
+
+    :param symmetric: Whether to follow each generator's data with data for its mirror (see
+    iterate_sharded_training_data).
+    :param compact: Whether to generate the data in the compact encoding. Packed files always
+    store bit vectors.
+    :param file_format: The format to save in (see save_data), or "chunked" to write the data to
+    a chunked dataset file (see ChunkedDatasetWriter) as it is generated.
+    """
+    if file_format == "chunked":
+        num_options = generators[0].option_card
+        max_size = metadata.max_num_people_per_option
+        if compact:
+            row_shape = (num_options, max_size, len(attribute_sizes))
+        else:
+            row_shape = (num_options * max_size * sum(attribute_sizes),)
+
+        num_rows = len(generators) * metadata.train_data_size * (2 if symmetric else 1)
+        with ChunkedDatasetWriter(name + "_chunks", metadata, row_shape, num_options,
+                                  num_rows=num_rows) as writer:
+            for data, labels in iterate_sharded_training_data(
+                    generators, max_size, metadata.train_data_size, seed=seed, workers=workers,
+                    compact=compact, symmetric=symmetric):
+                writer.append(data, labels)
+        return
+
+    data, labels = preprocess_data_before_saving(metadata, generators, seed=seed, workers=workers,
+                                                 compact=compact and file_format != "packed",
+                                                 symmetric=symmetric)
+    save_data(name, data, labels, metadata, file_format)
+
+
+def convert_data_file(name: str, file_format: str = "npy"):
+    """
+    Rewrites data saved under a name in another format. The old files are left in place, but
+    read_data_from_file reads the newest format.
+
+    :param name: The prefix of the files to convert.
+    :param file_format: The format to convert to (see save_data).
+    """
+    data, labels, metadata = read_data_from_file(name)
+    save_data(name, data, labels, metadata, file_format)
+
+
+def read_array_from_file(filename: str):
+    if is_packed_file(filename):
+        return read_packed_file(filename)
+
+    with open(filename, "r") as f:
+        return jsonpickle.decode(f.read())
+
+
+def saved_format(name: str):
+    """
+    :param name: The prefix of the files.
+    :return: The format data under the name was saved in: "chunked", "npy" or "jsonpickle" (which
+    includes packed files), or None if there is no data under the name. If it was saved in several
+    formats, the one whose metadata was written last wins, so converted data is read in the format
+    it was converted to.
+    """
+    metadata_files = [("chunked", name + "_chunks"), ("npy", name + "_metadata.json"),
+                      ("jsonpickle", name + "_metadata")]
+    saved = [(os.stat(filename).st_mtime_ns, -priority, file_format)
+             for priority, (file_format, filename) in enumerate(metadata_files)
+             if os.path.exists(filename)]
+    return max(saved)[2] if saved else None
+
+
 def read_data_from_file(name: str):
-    data_file = open(name + "_data", "r")
-    data = jsonpickle.decode(data_file.read())
-    data_file.close()
+    """
+    Reads data saved under a name in any format (see saved_format). Data in the npy format is
+    memory mapped read-only instead of read into memory. Use ChunkedDatasetReader directly to read
+    parts of a chunked dataset.
+
+    :param name: The prefix of the files to read.
+    :return: A tuple of the data, labels and TrainMetadata.
+    """
+    file_format = saved_format(name)
+
+    if file_format == "chunked":
+        reader = ChunkedDatasetReader(name + "_chunks")
+        data, labels = reader.read()
+        return data, labels, reader.metadata
 
-    labels_file = open(name + "_labels", "r")
-    labels = jsonpickle.decode(labels_file.read())
-    labels_file.close()
+    if file_format == "npy":
+        with open(name + "_metadata.json", "r") as f:
+            obj = json.load(f)
+
+        return (np.load(name + "_data.npy", mmap_mode="r"),
+                np.load(name + "_labels.npy", mmap_mode="r"),
+                TrainMetadata(obj["train_data_size"], obj["max_num_people_per_option"]))
+
+    data = read_array_from_file(name + "_data")
+    labels = read_array_from_file(name + "_labels")
 
     metadata_file = open(name + "_metadata", "r")
     metadata = jsonpickle.decode(metadata_file.read())
     metadata_file.close()
 
     return data, labels, metadata
+
+
+class TrainingDataCache:
+
+    def __init__(self, directory: str = None, max_bytes: int = 8 * 1024 ** 3):
+        """
+        A cache of generated training sets on disk, keyed by a hash of everything the data depends
+        on. Each entry is saved in the npy format (see save_data), so cached data is memory mapped
+        instead of read into memory. The least recently used entries are evicted once the cache
+        holds more than max_bytes.
+
+        :param directory: The directory entries are saved in. Defaults to the training_data
+        directory of default_cache_dir().
+        :param max_bytes: The maximum size of all entries together.
+        """
+        if directory is None:
+            directory = os.path.join(default_cache_dir(), "training_data")
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(option_cpd, jaywalking_cpd, metadata: TrainMetadata, seed: int = None,
+            compact: bool = False, symmetric: bool = False) -> str:
+        """
+        :return: The cache key for training data generated from the parameters. Data generated
+        without a seed is keyed like any other seed, so the first such data is reused.
+        """
+        encoded = json.dumps({
+            "option_cpd": [float(x) for x in option_cpd],
+            "jaywalking_cpd": [float(x) for x in jaywalking_cpd],
+            "train_data_size": metadata.train_data_size,
+            "max_num_people_per_option": metadata.max_num_people_per_option,
+            "seed": seed,
+            "compact": compact,
+            "symmetric": symmetric
+        }, sort_keys=True)
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str):
+        """
+        :param key: The cache key.
+        :return: A tuple of the memory mapped data, labels and TrainMetadata, or None if the key is
+        not cached.
+        """
+        path = self.path(key)
+        try:
+            data = read_data_from_file(os.path.join(path, "data"))
+            # Mark the entry as recently used.
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key: str, data, labels, metadata: TrainMetadata):
+        """
+        Caches training data and evicts the least recently used entries if the cache is too big.
+
+        :param key: The cache key.
+        :return: A tuple of the memory mapped data, labels and TrainMetadata.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Save to a temporary directory first so concurrent readers never see a partial entry.
+        temp_path = tempfile.mkdtemp(dir=self.directory, suffix=".tmp")
+        try:
+            save_data(os.path.join(temp_path, "data"), data, labels, metadata, "npy")
+        except BaseException:
+            # evict never looks at temporary directories, so nothing else would remove it.
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise
+
+        try:
+            os.rename(temp_path, self.path(key))
+        except OSError:
+            # Another process cached the same data first.
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+        self.evict(keep=key)
+        return self.get(key)
+
+    def get_or_generate(self, key: str, generate):
+        """
+        :param key: The cache key.
+        :param generate: A function which returns a tuple of the data, labels and TrainMetadata to
+        cache if the key is not cached.
+        :return: A tuple of the memory mapped data, labels and TrainMetadata.
+        """
+        entry = self.get(key)
+        if entry is None:
+            entry = self.put(key, *generate())
+        return entry
+
+    def evict(self, keep: str = None):
+        """
+        Removes the least recently used entries until the cache holds at most max_bytes.
+
+        :param keep: A key which is never evicted.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp") or not os.path.isdir(path):
+                continue
+
+            try:
+                size = sum(os.path.getsize(os.path.join(path, filename))
+                           for filename in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, name))
+            except OSError:
+                # Evicted by another process.
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+
+            shutil.rmtree(self.path(name), ignore_errors=True)
+            total -= size
+
+
+class CheckpointStore:
+
+    def __init__(self, directory: str, run: str = None):
+        """
+        A store of the weights of trained models, keyed by the run which trained them, the cell of
+        the sweep they were trained for, their repeat, the seed of their training data, the
+        backend and whether they were warm started. The weights of each model are saved to a .npz
+        file of their own, and the index file lists every model saved with what it was trained on,
+        one JSON line per model. Lines are written with a single append, so several processes can
+        save to the same store.
+
+        :param directory: The directory of the store.
+        :param run: The identity of the run saving models, or None for a new random one. Every run
+        keeps its own models, so sweeps saving to the same store never replace each other's.
+        """
+        self.directory = directory
+        self.run = uuid.uuid4().hex if run is None else run
+
+    @staticmethod
+    def key(option_cpd, jaywalking_cpd, repeat: int, seed: int = None, run: str = None,
+            backend: str = "keras", warm_start_epochs: int = None) -> str:
+        encoded = json.dumps({
+            "option_cpd": [float(x) for x in option_cpd],
+            "jaywalking_cpd": [float(x) for x in jaywalking_cpd],
+            "repeat": repeat,
+            "seed": seed,
+            "run": run,
+            "backend": backend,
+            "warm_start_epochs": warm_start_epochs
+        }, sort_keys=True)
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.directory, "index")
+
+    def save(self, option_cpd, jaywalking_cpd, repeat: int, seed: int, weights,
+             backend: str = "keras", warm_start_epochs: int = None, **info):
+        """
+        Saves the weights of a model. A model saved with the same key by this run before is
+        replaced.
+
+        :param weights: The weights, as a Keras model's get_weights returns them.
+        :param backend: The backend the model was trained with.
+        :param warm_start_epochs: The warm start epochs of the sweep the model was trained in (see
+        WarmStart), or None if the sweep trained every model from random weights.
+        :param info: Anything else to record in the index, such as the layer sizes.
+        :return: The key of the model.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        key = CheckpointStore.key(option_cpd, jaywalking_cpd, repeat, seed, self.run, backend,
+                                  warm_start_epochs)
+
+        # Write to a temporary file first so concurrent readers never see a partial file.
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, *[np.asarray(array, dtype=np.float32) for array in weights])
+        os.replace(temp_path, os.path.join(self.directory, key + ".npz"))
+
+        line = (json.dumps(dict(info, key=key, option_cpd=[float(x) for x in option_cpd],
+                                jaywalking_cpd=[float(x) for x in jaywalking_cpd],
+                                repeat=repeat, seed=seed, run=self.run, backend=backend,
+                                warm_start_epochs=warm_start_epochs)) + "\n").encode()
+        fd = os.open(self.index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        return key
+
+    def entries(self):
+        """
+        :return: The index entry of every model in the store, in the order they were saved.
+        """
+        entries = {}
+        try:
+            with open(self.index_path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line being written by another process.
+                        continue
+                    entries.pop(entry["key"], None)
+                    entries[entry["key"]] = entry
+        except FileNotFoundError:
+            pass
+        return list(entries.values())
+
+    def load(self, key: str):
+        """
+        :param key: The key of the model.
+        :return: The weights of the model, as a Keras model's get_weights returns them.
+        """
+        with np.load(os.path.join(self.directory, key + ".npz")) as weights:
+            return [weights["arr_%d" % i] for i in range(len(weights.files))]
+
+
+class SharedArrays:
+
+    def __init__(self, arrays):
+        """
+        Copies arrays into shared memory once so other processes can attach to them without
+        copying or deserializing anything. The process which publishes the arrays owns the shared
+        memory and must close it when every other process is done with it.
+
+        :param arrays: The arrays to publish.
+        """
+        self.blocks = []
+        self.handle = []
+        for array in arrays:
+            array = np.asarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.blocks.append(block)
+            self.handle.append((block.name, array.shape, array.dtype.str))
+
+    @staticmethod
+    def attach(handle):
+        """
+        Attaches to published arrays.
+
+        :param handle: The handle of the published arrays (SharedArrays.handle).
+        :return: A tuple of the read-only arrays and the shared memory blocks backing them, which
+        must be kept alive as long as the arrays are used.
+        """
+        arrays = []
+        blocks = []
+        for name, shape, dtype in handle:
+            block = shared_memory.SharedMemory(name=name)
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+            array.flags.writeable = False
+            arrays.append(array)
+            blocks.append(block)
+        return arrays, blocks
+
+    def close(self):
+        """
+        Frees the shared memory.
+        """
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TestPackedFile(unittest.TestCase):
+
+    def testRoundTrip(self):
+        array = np.random.default_rng(0).integers(0, 2, size=(10, 2 * 3 * 22))
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "test_data")
+            write_packed_file(filename, array, 2, 3, chunk_size=4)
+
+            self.assertTrue(is_packed_file(filename))
+            self.assertEqual(read_packed_header(filename), (10, 2, 3, 2 * 3 * 22))
+            self.assertEqual(os.path.getsize(filename), packed_data_offset + 10 * 17)
+            self.assertTrue(np.array_equal(read_packed_file(filename), array))
+            self.assertTrue(np.array_equal(read_packed_file(filename, 3, 7), array[3:7]))
+
+
+class TestSaveData(unittest.TestCase):
+
+    def testConvertToNpy(self):
+        data = np.random.default_rng(0).integers(0, 2, size=(10, 2 * 3 * 22))
+        labels = np.eye(2, dtype=np.int64)[np.arange(10) % 2]
+
+        with tempfile.TemporaryDirectory() as directory:
+            name = os.path.join(directory, "test")
+            save_data(name, data, labels, TrainMetadata(5, 3))
+            convert_data_file(name, "npy")
+
+            read_data, read_labels, metadata = read_data_from_file(name)
+
+            self.assertIsInstance(read_data, np.memmap)
+            self.assertTrue(np.array_equal(read_data, data))
+            self.assertTrue(np.array_equal(read_labels, labels))
+            self.assertEqual(metadata.train_data_size, 5)
+            self.assertEqual(metadata.max_num_people_per_option, 3)
+
+    def testReadsNewestFormat(self):
+        data = np.random.default_rng(0).integers(0, 2, size=(10, 2 * 3 * 22))
+        labels = np.eye(2, dtype=np.int64)[np.arange(10) % 2]
+
+        with tempfile.TemporaryDirectory() as directory:
+            name = os.path.join(directory, "test")
+            save_data(name, data, labels, TrainMetadata(5, 3), "npy")
+            self.assertEqual(saved_format(name), "npy")
+
+            for file_format, array_type in [("packed", np.ndarray), ("npy", np.memmap)]:
+                convert_data_file(name, file_format)
+                read_data, read_labels, _ = read_data_from_file(name)
+
+                self.assertIs(type(read_data), array_type)
+                self.assertTrue(np.array_equal(read_data, data))
+                self.assertTrue(np.array_equal(read_labels, labels))
+
+
+class TestChunkedDataset(unittest.TestCase):
+
+    def testAppendAndRead(self):
+        rng = np.random.default_rng(0)
+        data = rng.integers(0, 2, size=(25, 2 * 3 * 22))
+        labels = np.eye(2, dtype=np.int64)[rng.integers(0, 2, size=25)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "test_chunks")
+            with ChunkedDatasetWriter(filename, TrainMetadata(25, 3), (2 * 3 * 22,), 2,
+                                      chunk_size=10) as writer:
+                for start in range(0, 25, 7):
+                    writer.append(data[start:start + 7], labels[start:start + 7])
+
+            reader = ChunkedDatasetReader(filename)
+
+            self.assertEqual(len(reader), 25)
+            self.assertEqual([rows for _, rows in reader.index], [10, 10, 5])
+            self.assertEqual(reader.metadata.max_num_people_per_option, 3)
+            self.assertTrue(np.array_equal(np.concatenate([x for x, _ in reader.chunks()]), data))
+
+            read_data, read_labels = reader.read(8, 23)
+            self.assertTrue(np.array_equal(read_data, data[8:23]))
+            self.assertTrue(np.array_equal(read_labels, labels[8:23]))
+
+    def testInterruptedWriteLeavesNoFile(self):
+        data = np.zeros((50, 2 * 3 * 22), dtype=np.uint8)
+        labels = np.eye(2, dtype=np.uint8)[np.arange(50) % 2]
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "test_chunks")
+            with self.assertRaises(KeyboardInterrupt):
+                with ChunkedDatasetWriter(filename, TrainMetadata(1000, 3), (2 * 3 * 22,), 2,
+                                          chunk_size=10, num_rows=1000) as writer:
+                    writer.append(data, labels)
+                    raise KeyboardInterrupt()
+
+            self.assertEqual(os.listdir(directory), [])
+
+            # Closing a writer which got fewer rows than it was promised fails the same way.
+            writer = ChunkedDatasetWriter(filename, TrainMetadata(1000, 3), (2 * 3 * 22,), 2,
+                                          num_rows=1000)
+            writer.append(data, labels)
+            with self.assertRaises(ValueError):
+                writer.close()
+            self.assertEqual(os.listdir(directory), [])
+
+    def testReaderChecksRowCount(self):
+        data = np.zeros((50, 2 * 3 * 22), dtype=np.uint8)
+        labels = np.eye(2, dtype=np.uint8)[np.arange(50) % 2]
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "test_chunks")
+            writer = ChunkedDatasetWriter(filename, TrainMetadata(1000, 3), (2 * 3 * 22,), 2,
+                                          num_rows=50)
+            writer.append(data, labels)
+            writer.close()
+
+            # Claim more rows in the header than the file holds, like a file cut short.
+            with open(filename, "r+b") as f:
+                contents = f.read()
+                f.seek(0)
+                f.write(contents.replace(b'"num_rows": 50', b'"num_rows": 99'))
+
+            with self.assertRaises(ValueError):
+                ChunkedDatasetReader(filename)
+
+
+class TestTrainingDataCache(unittest.TestCase):
+
+    def testGetOrGenerate(self):
+        metadata = TrainMetadata(4, 2)
+        data = np.arange(4 * 2 * 2 * 5, dtype=np.uint8).reshape(4, 2, 2, 5)
+        labels = np.eye(2, dtype=np.uint8)[[0, 1, 1, 0]]
+        calls = []
+
+        def generate():
+            calls.append(1)
+            return data, labels, metadata
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = TrainingDataCache(directory)
+            key = TrainingDataCache.key([0.5, 0.5], [0.2, 0.8], metadata, seed=1, compact=True)
+            self.assertNotEqual(key, TrainingDataCache.key([0.5, 0.5], [0.2, 0.8], metadata,
+                                                           seed=2, compact=True))
+
+            for _ in range(2):
+                cached_data, cached_labels, cached_metadata = cache.get_or_generate(key, generate)
+                self.assertIsInstance(cached_data, np.memmap)
+                self.assertTrue(np.array_equal(cached_data, data))
+                self.assertTrue(np.array_equal(cached_labels, labels))
+                self.assertEqual(cached_metadata.train_data_size, 4)
+
+            self.assertEqual(len(calls), 1)
+
+    def testEvictsLeastRecentlyUsed(self):
+        metadata = TrainMetadata(4, 2)
+        data = np.zeros((4, 20), dtype=np.uint8)
+        labels = np.eye(2, dtype=np.uint8)[[0, 1, 1, 0]]
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = TrainingDataCache(directory, max_bytes=0)
+            cache.put("a", data, labels, metadata)
+            cache.put("b", data, labels, metadata)
+
+            self.assertIsNone(cache.get("a"))
+            self.assertIsNotNone(cache.get("b"))
+
+
+    def testFailedPutLeavesNothingBehind(self):
+        metadata = TrainMetadata(4, 2)
+        data = np.zeros((4, 20), dtype=np.uint8)
+        labels = np.eye(2, dtype=np.uint8)[[0, 1, 1, 0]]
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = TrainingDataCache(directory)
+            with mock.patch("numpy.save", side_effect=OSError("No space left on device")):
+                with self.assertRaises(OSError):
+                    cache.put("key", data, labels, metadata)
+
+            self.assertEqual(os.listdir(directory), [])
+
+
+class TestCheckpointStore(unittest.TestCase):
+
+    def testSaveAndLoad(self):
+        weights = [np.ones((3, 2)), np.zeros(2)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = CheckpointStore(directory)
+            self.assertEqual(store.entries(), [])
+
+            store.save([0.5, 0.5], [0.2, 0.8], 0, 1, weights, epochs=5)
+            store.save([0.5, 0.5], [0.2, 0.8], 1, 1, weights, epochs=5)
+            key = store.save([0.5, 0.5], [0.2, 0.8], 0, 1, [2 * w for w in weights], epochs=3)
+
+            entries = store.entries()
+            self.assertEqual([entry["repeat"] for entry in entries], [1, 0])
+            self.assertEqual(entries[1]["key"], key)
+            self.assertEqual(entries[1]["epochs"], 3)
+
+            loaded = store.load(key)
+            self.assertEqual(len(loaded), 2)
+            self.assertTrue(np.array_equal(loaded[0], 2 * np.ones((3, 2))))
+            self.assertEqual(loaded[0].dtype, np.float32)
+
+    def testRunsKeepTheirOwnModels(self):
+        weights = [np.ones((3, 2)), np.zeros(2)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            CheckpointStore(directory).save([0.5, 0.5], [0.2, 0.8], 0, None, weights)
+            warm = CheckpointStore(directory)
+            warm.save([0.5, 0.5], [0.2, 0.8], 0, None, weights, warm_start_epochs=2)
+            warm.save([0.5, 0.5], [0.2, 0.8], 0, None, weights, backend="numpy",
+                      warm_start_epochs=2)
+
+            entries = CheckpointStore(directory).entries()
+            self.assertEqual(len(entries), 3)
+            self.assertNotEqual(entries[0]["run"], entries[1]["run"])
+            self.assertEqual([entry["warm_start_epochs"] for entry in entries], [None, 2, 2])
+            self.assertEqual([entry["backend"] for entry in entries], ["keras", "keras", "numpy"])
+
+
+class TestSharedArrays(unittest.TestCase):
+
+    def testAttach(self):
+        data = np.arange(12, dtype=np.uint8).reshape(3, 4)
+        labels = np.eye(2, dtype=np.int64)
+
+        with SharedArrays([data, labels]) as shared:
+            (shared_data, shared_labels), blocks = SharedArrays.attach(shared.handle)
+
+            self.assertTrue(np.array_equal(shared_data, data))
+            self.assertTrue(np.array_equal(shared_labels, labels))
+            self.assertFalse(shared_data.flags.writeable)
+
+            del shared_data, shared_labels
+            for block in blocks:
+                block.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
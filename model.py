@@ -13,11 +13,13 @@
 # You should have received a copy of the GNU General Public License
 # along with MoralAI.  If not, see <https://www.gnu.org/licenses/>.
 
+import itertools
 import unittest
 from enum import Enum
-from functools import reduce
 from typing import List
 
+import numpy as np
+
 
 class Race(Enum):
     white = 1
@@ -69,6 +71,65 @@ driving_under_the_influence_mapping = {
     False: [0, 0, 1]
 }
 
+# The compact encoding of a person is the index of the set bit in each attribute's part of the
+# exported bit vector (see Person.export_as_list), in the order age, race, legal sex, jaywalking,
+# driving under the influence. Padding people have padding_index for every attribute.
+attribute_sizes = [7, 6, 3, 3, 3]
+attribute_offsets = [0, 7, 13, 16, 19]
+padding_index = 255
+
+# For each attribute, the exported bits for every possible compact index. Indices which are not
+# states of the attribute (like padding_index) map to all zeros.
+attribute_export_tables = [np.eye(256, size, dtype=np.uint8) for size in attribute_sizes]
+
+
+def compact_to_export(indices, dtype=np.uint8):
+    """
+    Expands compactly encoded people to their exported bit vectors.
+
+    :param indices: The compact encoding, an array of shape (..., 5).
+    :param dtype: The dtype of the returned array.
+    :return: The bit vectors, an array of shape (..., 22).
+    """
+    indices = np.asarray(indices)
+    export = np.empty(indices.shape[:-1] + (sum(attribute_sizes),), dtype=dtype)
+    for i, (size, offset) in enumerate(zip(attribute_sizes, attribute_offsets)):
+        export[..., offset:offset + size] = attribute_export_tables[i][indices[..., i]]
+    return export
+
+
+def export_to_compact(export, num_options: int, max_size: int):
+    """
+    Compacts exported dilemmas (generated by Dilemma.export_as_list).
+
+    :param export: The bit vectors of the dilemmas, an array of shape (n, num_options * max_size *
+    22).
+    :param num_options: The number of options in each dilemma.
+    :param max_size: The maximum number of people in an option.
+    :return: The compact encoding, a uint8 array of shape (n, num_options, max_size, 5).
+    """
+    people = np.asarray(export).reshape(-1, num_options, max_size, sum(attribute_sizes))
+    indices = np.empty(people.shape[:-1] + (len(attribute_sizes),), dtype=np.uint8)
+    for i, (size, offset) in enumerate(zip(attribute_sizes, attribute_offsets)):
+        bits = people[..., offset:offset + size]
+        indices[..., i] = np.where(bits.any(axis=-1), bits.argmax(axis=-1), padding_index)
+    return indices
+
+
+def count_jaywalkers_per_option(export, num_options: int, max_size: int):
+    """
+    Counts the jaywalkers in each option of exported dilemmas without creating the dilemmas.
+
+    :param export: The bit vectors of the dilemmas, an array of shape (n, num_options * max_size *
+    22).
+    :param num_options: The number of options in each dilemma.
+    :param max_size: The maximum number of people in an option.
+    :return: The number of jaywalkers in each option, an array of shape (n, num_options).
+    """
+    jaywalking_column = attribute_offsets[3] + jaywalking_mapping[True].index(1)
+    people = np.asarray(export).reshape(-1, num_options, max_size, sum(attribute_sizes))
+    return np.count_nonzero(people[..., jaywalking_column], axis=-1)
+
 
 def create_person_from_export(export):
     """
@@ -77,6 +138,9 @@ def create_person_from_export(export):
     :param export: The bit vector representing the person.
     :return: The person.
     """
+    person = people_by_export.get(tuple(export))
+    if person is not None:
+        return person
 
     def lookup_from_export(mapping, slice):
         try:
@@ -96,47 +160,69 @@ def create_person_from_export(export):
     )
 
 
+def bucket_age(age):
+    """
+    :param age: An age, or None.
+    :return: The first age of the age bracket the age is in (see age_mapping), or None.
+    """
+    if age is None:
+        return None
+    if age <= 10:
+        return 1
+    return min((age - 1) // 10 * 10 + 1, 51)
+
+
 class Person:
+    """
+    A person. There are only a few thousand distinct people, so every person is interned: creating
+    a person returns the one shared instance with those attributes. People are immutable.
+    """
 
-    def __init__(self, age: int = None, race: Race = None, legal_sex: LegalSex = None,
-                 jaywalking: bool = None, driving_under_the_influence: bool = None):
-        self.age = age
+    __slots__ = ["age", "race", "legal_sex", "jaywalking", "driving_under_the_influence",
+                 "state"]
 
-        if self.age is not None:
-            if self.age <= 10:
-                self.age = 1
-            elif 11 <= self.age <= 20:
-                self.age = 11
-            elif 21 <= self.age <= 30:
-                self.age = 21
-            elif 31 <= self.age <= 40:
-                self.age = 31
-            elif 41 <= self.age <= 50:
-                self.age = 41
-            else:
-                self.age = 51
+    def __new__(cls, age: int = None, race: Race = None, legal_sex: LegalSex = None,
+                jaywalking: bool = None, driving_under_the_influence: bool = None):
+        try:
+            return people_by_attributes[(bucket_age(age), race, legal_sex, jaywalking,
+                                         driving_under_the_influence)]
+        except KeyError:
+            raise ValueError("Invalid person: ", age, race, legal_sex, jaywalking,
+                             driving_under_the_influence)
 
-        self.race = race
-        self.legal_sex = legal_sex
-        self.jaywalking = jaywalking
-        self.driving_under_the_influence = driving_under_the_influence
+    def __setattr__(self, key, value):
+        raise AttributeError("People are immutable")
+
+    def __reduce__(self):
+        return Person, (self.age, self.race, self.legal_sex, self.jaywalking,
+                        self.driving_under_the_influence)
 
     def __eq__(self, o: object) -> bool:
         if isinstance(o, Person):
-            return self.age == o.age and self.race == o.race and self.legal_sex == o.legal_sex \
-                   and self.jaywalking == o.jaywalking and self.driving_under_the_influence == \
-                   o.driving_under_the_influence
+            return self.state == o.state
         return False
 
+    def __hash__(self):
+        return self.state
+
+    def __repr__(self):
+        return "Person(age={}, race={}, legal_sex={}, jaywalking={}, " \
+               "driving_under_the_influence={})".format(self.age, self.race, self.legal_sex,
+                                                        self.jaywalking,
+                                                        self.driving_under_the_influence)
+
     def export_as_list(self):
         """
         Exports this person as a list (bit vector).
         :return: The list of bits representing this person.
         """
-        return age_mapping[self.age] + race_mapping[self.race] + legal_sex_mapping[self.legal_sex] + \
-               jaywalking_mapping[
-                   self.jaywalking] + driving_under_the_influence_mapping[
-                   self.driving_under_the_influence]
+        return list(person_exports[self.state])
+
+    def export_columns(self):
+        """
+        :return: The columns of the bits set in this person's bit vector.
+        """
+        return person_export_columns[self.state]
 
     @staticmethod
     def export_empty_person_as_list():
@@ -151,6 +237,68 @@ class Person:
                 0, 0, 0]
 
 
+attribute_mappings = [age_mapping, race_mapping, legal_sex_mapping, jaywalking_mapping,
+                      driving_under_the_influence_mapping]
+
+# For each attribute, the compact index (see attribute_sizes) of each value.
+attribute_indices = [{value: bits.index(1) for value, bits in mapping.items()} for mapping in
+                     attribute_mappings]
+
+
+def person_state(age, race, legal_sex, jaywalking, driving_under_the_influence) -> int:
+    """
+    :return: The index of the person with these (bucketed) attributes in people.
+    """
+    state = 0
+    for indices, size, value in zip(attribute_indices, attribute_sizes,
+                                    (age, race, legal_sex, jaywalking,
+                                     driving_under_the_influence)):
+        state = state * size + indices[value]
+    return state
+
+
+def create_people():
+    created = []
+    for values in itertools.product(*[list(mapping.keys()) for mapping in attribute_mappings]):
+        person = object.__new__(Person)
+        for name, value in zip(Person.__slots__, values + (person_state(*values),)):
+            object.__setattr__(person, name, value)
+        created.append(person)
+    return created
+
+
+# Every distinct person, indexed by state.
+people = create_people()
+
+# Every person keyed by their (bucketed) attributes.
+people_by_attributes = {(person.age, person.race, person.legal_sex, person.jaywalking,
+                         person.driving_under_the_influence): person for person in people}
+
+
+def create_person_export_columns():
+    return [tuple(
+        offset + indices[value] for offset, indices, value in zip(
+            attribute_offsets, attribute_indices,
+            (person.age, person.race, person.legal_sex, person.jaywalking,
+             person.driving_under_the_influence))
+    ) for person in people]
+
+
+# The columns of the bits set in every person's bit vector, indexed by state.
+person_export_columns = create_person_export_columns()
+
+# The bit vector of every person, indexed by state.
+person_encodings = np.zeros((len(people), sum(attribute_sizes)), dtype=np.uint8)
+for state, columns in enumerate(person_export_columns):
+    person_encodings[state, list(columns)] = 1
+person_exports = [tuple(encoding) for encoding in person_encodings.tolist()]
+
+# Every person keyed by their bit vector. The empty bit vector, used for padding, decodes to a
+# person with no attributes.
+people_by_export = {export: person for export, person in zip(person_exports, people)}
+people_by_export[(0,) * sum(attribute_sizes)] = people[0]
+
+
 def create_dilemma_from_export(export, num_options: int, max_size: int):
     """
     Creates a dilemma from a bit vector (generated by Dilemma.export_as_list) representing that
@@ -203,16 +351,180 @@ class Dilemma:
         :return: A list of bits representing the people, padded to self.max_size number of people.
         """
 
-        return [
-            *([] if len(option) is 0 else reduce(
-                lambda a, b: a + b, map(lambda a: a.export_as_list(), option)
-            )),
-            *(Person.export_empty_person_as_list() * (self.max_size - len(option)))
-        ]
+        export = []
+        for person in option:
+            export.extend(person_exports[person.state])
+        export.extend(Person.export_empty_person_as_list() * (self.max_size - len(option)))
+        return export
 
     def export_as_list(self):
         return [i for j in self.options for i in self.export_option(j)]
 
+    def export_length(self):
+        """
+        :return: The length of this dilemma's bit vector.
+        """
+        return len(self.options) * self.max_size * sum(attribute_sizes)
+
+    def export_into(self, buffer, offset: int = 0):
+        """
+        Writes this dilemma's bit vector (see export_as_list) into a buffer.
+
+        :param buffer: A 1D numpy array to write into.
+        :param offset: The index in the buffer to start writing at.
+        :return: The index in the buffer just after this dilemma.
+        """
+        person_length = sum(attribute_sizes)
+        end = offset + self.export_length()
+        buffer[offset:end] = 0
+
+        columns = []
+        for i, option in enumerate(self.options):
+            for j, person in enumerate(option):
+                start = offset + (i * self.max_size + j) * person_length
+                columns.extend(start + column for column in person.export_columns())
+
+        buffer[columns] = 1
+        return end
+
+    def export_as_array(self, dtype=np.int64):
+        """
+        :param dtype: The dtype of the returned array.
+        :return: This dilemma's bit vector (see export_as_list) as a numpy array.
+        """
+        buffer = np.empty(self.export_length(), dtype=dtype)
+        self.export_into(buffer)
+        return buffer
+
+
+attribute_names = ["age", "race", "legal_sex", "jaywalking", "driving_under_the_influence"]
+
+# The compact encoding of every person indexed by state, followed by the compact encoding of
+# padding.
+person_compact = np.array(
+    [[indices[getattr(person, name)] for indices, name in zip(attribute_indices, attribute_names)]
+     for person in people] + [[padding_index] * len(attribute_sizes)],
+    dtype=np.uint8
+)
+
+
+class DilemmaBatch:
+
+    def __init__(self, age, race, legal_sex, jaywalking, driving_under_the_influence):
+        """
+        A batch of dilemmas stored as one column per attribute. Each column is an array of shape
+        (n, options, max_size) holding the compact index (see attribute_sizes) of that attribute
+        of every person, with padding_index for slots without a person.
+
+        :param age: The age column.
+        :param race: The race column.
+        :param legal_sex: The legal sex column.
+        :param jaywalking: The jaywalking column.
+        :param driving_under_the_influence: The driving under the influence column.
+        """
+        self.age = age
+        self.race = race
+        self.legal_sex = legal_sex
+        self.jaywalking = jaywalking
+        self.driving_under_the_influence = driving_under_the_influence
+
+        # The number of people in each option, shape (n, options).
+        self.num_people = np.count_nonzero(age != padding_index, axis=-1)
+
+    @property
+    def num_dilemmas(self) -> int:
+        return self.age.shape[0]
+
+    @property
+    def num_options(self) -> int:
+        return self.age.shape[1]
+
+    @property
+    def max_size(self) -> int:
+        return self.age.shape[2]
+
+    def columns(self):
+        return [self.age, self.race, self.legal_sex, self.jaywalking,
+                self.driving_under_the_influence]
+
+    @staticmethod
+    def from_compact(compact):
+        """
+        :param compact: The compact encoding, an array of shape (n, options, max_size, 5).
+        :return: The batch.
+        """
+        return DilemmaBatch(*[compact[..., i] for i in range(len(attribute_sizes))])
+
+    def to_compact(self):
+        """
+        :return: The compact encoding, a uint8 array of shape (n, options, max_size, 5).
+        """
+        return np.stack(self.columns(), axis=-1).astype(np.uint8, copy=False)
+
+    @staticmethod
+    def from_export(export, num_options: int, max_size: int):
+        """
+        :param export: The bit vectors of the dilemmas (see Dilemma.export_as_list), an array of
+        shape (n, num_options * max_size * 22).
+        :param num_options: The number of options in each dilemma.
+        :param max_size: The maximum number of people in an option.
+        :return: The batch.
+        """
+        return DilemmaBatch.from_compact(export_to_compact(export, num_options, max_size))
+
+    def to_export(self, dtype=np.uint8):
+        """
+        :param dtype: The dtype of the returned array.
+        :return: The bit vectors of the dilemmas, an array of shape
+        (n, options * max_size * 22).
+        """
+        return compact_to_export(self.to_compact(), dtype=dtype).reshape(self.num_dilemmas, -1)
+
+    @staticmethod
+    def from_dilemmas(dilemmas):
+        """
+        :param dilemmas: The dilemmas. They must all have the same number of options and the same
+        max_size.
+        :return: The batch.
+        """
+        num_options = len(dilemmas[0].options)
+        max_size = dilemmas[0].max_size
+
+        # Padding slots index the padding row at the end of person_compact.
+        states = np.full((len(dilemmas), num_options, max_size), len(people), dtype=np.intp)
+        for i, dilemma in enumerate(dilemmas):
+            for j, option in enumerate(dilemma.options):
+                states[i, j, :len(option)] = [person.state for person in option]
+
+        return DilemmaBatch.from_compact(person_compact[states])
+
+    def to_dilemmas(self):
+        """
+        :return: The dilemmas as a list of Dilemma. Padding slots are dropped.
+        """
+        states = np.zeros(self.age.shape, dtype=np.intp)
+        for column, size in zip(self.columns(), attribute_sizes):
+            states = states * size + column
+        padding = self.age == padding_index
+
+        return [
+            Dilemma([[people[state] for state in option_states[~option_padding].tolist()]
+                     for option_states, option_padding in zip(dilemma_states, dilemma_padding)],
+                    self.max_size)
+            for dilemma_states, dilemma_padding in zip(states, padding)
+        ]
+
+    def count(self, attribute: str, value):
+        """
+        Counts the people in each option with an attribute set to a value.
+
+        :param attribute: The name of the attribute, one of attribute_names.
+        :param value: The value, for example True for jaywalking or Race.white for race.
+        :return: The counts, an array of shape (n, options).
+        """
+        index = attribute_indices[attribute_names.index(attribute)][value]
+        return np.count_nonzero(getattr(self, attribute) == index, axis=-1)
+
 
 class TestPersonExport(unittest.TestCase):
 
@@ -250,6 +562,25 @@ class TestPersonExport(unittest.TestCase):
             ]
         )
 
+    def testPeopleAreInterned(self):
+        self.assertIs(Person(age=16, race=Race.white), Person(age=19, race=Race.white))
+        self.assertEqual(len({Person(age=age) for age in range(0, 100)}), 6)
+        self.assertEqual(len(people), 7 * 6 * 3 * 3 * 3)
+        self.assertEqual(person_encodings.shape, (1134, 22))
+
+        with self.assertRaises(AttributeError):
+            Person().age = 1
+
+    def testEncodingsMatchMappings(self):
+        for person in people:
+            self.assertEqual(
+                person.export_as_list(),
+                age_mapping[person.age] + race_mapping[person.race] +
+                legal_sex_mapping[person.legal_sex] + jaywalking_mapping[person.jaywalking] +
+                driving_under_the_influence_mapping[person.driving_under_the_influence]
+            )
+            self.assertIs(create_person_from_export(person.export_as_list()), person)
+
 
 class TestPersonFromExport(unittest.TestCase):
 
@@ -418,6 +749,19 @@ class TestDilemmaExport(unittest.TestCase):
             raw
         )
 
+    def testExportIntoMatchesExportAsList(self):
+        dilemma = Dilemma([
+            [Person(age=16, race=Race.asian, jaywalking=True), Person()],
+            [],
+            [Person(legal_sex=LegalSex.female, driving_under_the_influence=True)]
+        ], 3)
+        buffer = np.full(2 * dilemma.export_length() + 1, 7)
+
+        self.assertEqual(dilemma.export_into(buffer, 1), dilemma.export_length() + 1)
+        self.assertEqual(buffer[0], 7)
+        self.assertEqual(buffer[1:dilemma.export_length() + 1].tolist(), dilemma.export_as_list())
+        self.assertEqual(dilemma.export_as_array().tolist(), dilemma.export_as_list())
+
 
 class TestDilemmaFromExport(unittest.TestCase):
 
@@ -446,5 +790,67 @@ class TestDilemmaFromExport(unittest.TestCase):
         )
 
 
+class TestCompactEncoding(unittest.TestCase):
+
+    def testRoundTrip(self):
+        dilemma = Dilemma([
+            [Person(age=16, race=Race.asian, legal_sex=LegalSex.male, jaywalking=True), Person()],
+            [Person(driving_under_the_influence=False)],
+            []
+        ], 2)
+        export = np.array([dilemma.export_as_list()])
+
+        compact = export_to_compact(export, 3, 2)
+
+        self.assertEqual(compact.dtype, np.uint8)
+        self.assertEqual(compact.shape, (1, 3, 2, 5))
+        self.assertEqual(compact[0, 0, 0].tolist(), [2, 3, 1, 1, 0])
+        self.assertEqual(compact[0, 1, 0].tolist(), [0, 0, 0, 0, 2])
+        self.assertEqual(compact[0, 1, 1].tolist(), [padding_index] * 5)
+        self.assertEqual(compact_to_export(compact).reshape(1, -1).tolist(), export.tolist())
+
+
+class TestCountJaywalkers(unittest.TestCase):
+
+    def testCountJaywalkersMatchesDilemmas(self):
+        rng = np.random.default_rng(0)
+        compact = np.full((50, 2, 4, 5), padding_index, dtype=np.uint8)
+        for i, size in enumerate(attribute_sizes):
+            compact[..., i] = rng.integers(0, size, size=(50, 2, 4))
+        compact[rng.random((50, 2, 4)) < 0.3] = padding_index
+        export = compact_to_export(compact).reshape(50, -1)
+
+        counts = count_jaywalkers_per_option(export, 2, 4)
+
+        for row, row_counts in zip(export, counts):
+            dilemma = create_dilemma_from_export(row.tolist(), 2, 4)
+            self.assertEqual(row_counts.tolist(), [
+                len([person for person in option if person.jaywalking]) for option in
+                dilemma.options
+            ])
+
+
+class TestDilemmaBatch(unittest.TestCase):
+
+    def testRoundTrip(self):
+        dilemmas = [
+            Dilemma([[Person(age=16, race=Race.asian, jaywalking=True), Person()],
+                     [Person(jaywalking=True)]], 3),
+            Dilemma([[], [Person(legal_sex=LegalSex.female), Person(jaywalking=False),
+                          Person(age=70, jaywalking=True)]], 3)
+        ]
+        export = np.array([dilemma.export_as_list() for dilemma in dilemmas])
+
+        batch = DilemmaBatch.from_dilemmas(dilemmas)
+
+        self.assertEqual(batch.num_people.tolist(), [[2, 1], [0, 3]])
+        self.assertEqual(batch.count("jaywalking", True).tolist(), [[1, 1], [0, 1]])
+        self.assertEqual(batch.to_export().tolist(), export.tolist())
+        self.assertEqual(batch.to_dilemmas(), dilemmas)
+        self.assertEqual(DilemmaBatch.from_export(export, 2, 3).to_dilemmas(), dilemmas)
+        self.assertTrue(np.array_equal(DilemmaBatch.from_export(export, 2, 3).count(
+            "jaywalking", True), count_jaywalkers_per_option(export, 2, 3)))
+
+
 if __name__ == '__main__':
     unittest.main()
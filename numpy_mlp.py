@@ -0,0 +1,335 @@
+# This file is part of MoralAI.
+#
+# MoralAI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MoralAI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MoralAI.  If not, see <https://www.gnu.org/licenses/>.
+import importlib.util
+import unittest
+
+import numpy as np
+
+# The probabilities are clipped to [epsilon, 1 - epsilon] before taking their log, like Keras'
+# categorical crossentropy does, so the loss of a confidently wrong prediction stays finite.
+epsilon = 1e-7
+
+
+def glorot_uniform(rng, fan_in: int, fan_out: int, dtype=np.float32):
+    """
+    :return: New weights for a dense layer, drawn like Keras' default glorot_uniform initializer.
+    """
+    limit = np.sqrt(6 / (fan_in + fan_out))
+    return rng.uniform(-limit, limit, (fan_in, fan_out)).astype(dtype)
+
+
+def categorical_crossentropy(probabilities, labels):
+    """
+    :param probabilities: The predicted probability of each class for each row.
+    :param labels: The one-hot labels of each row.
+    :return: The loss of each row, computed like Keras computes it.
+    """
+    return -(labels * np.log(np.clip(probabilities, epsilon, 1 - epsilon))).sum(axis=-1)
+
+
+class NumpyMLP:
+
+    def __init__(self, layer_sizes, learning_rate: float = 0.01, seed=None, dtype=np.float32):
+        """
+        A multilayer perceptron with ReLU hidden layers and a softmax output layer, trained on
+        categorical crossentropy with plain SGD. It matches the Keras model train_iteration builds
+        (Glorot uniform weights, zero biases, and the learning rate of Keras' "sgd"), but has none
+        of Keras' startup or per-batch overhead. It has the fit, evaluate and predict methods
+        evaluate_model uses.
+
+        :param layer_sizes: The number of units of each layer, starting with the input layer.
+        :param learning_rate: The SGD learning rate.
+        :param seed: The seed for the initial weights and for shuffling, or None to seed from fresh
+        entropy.
+        :param dtype: The dtype of the weights and of the computation.
+        """
+        self.layer_sizes = layer_sizes
+        self.learning_rate = learning_rate
+        self.dtype = dtype
+        self.rng = np.random.default_rng(seed)
+        self.initialize()
+
+    def initialize(self):
+        """
+        Draws new initial weights, which makes this a new untrained model.
+        """
+        self.weights = [glorot_uniform(self.rng, fan_in, fan_out, self.dtype)
+                        for fan_in, fan_out in zip(self.layer_sizes[:-1], self.layer_sizes[1:])]
+        self.biases = [np.zeros(fan_out, dtype=self.dtype) for fan_out in self.layer_sizes[1:]]
+
+    def get_weights(self):
+        """
+        :return: Copies of the weights and biases of every layer, in the order Keras' get_weights
+        returns them.
+        """
+        return [array.copy() for layer in zip(self.weights, self.biases) for array in layer]
+
+    def set_weights(self, weights):
+        """
+        :param weights: The weights and biases of every layer, as get_weights returns them.
+        """
+        self.weights = [np.array(array, dtype=self.dtype) for array in weights[0::2]]
+        self.biases = [np.array(array, dtype=self.dtype) for array in weights[1::2]]
+
+    def forward(self, data):
+        """
+        :param data: A batch of inputs.
+        :return: A tuple of the activations of every layer but the output layer, starting with the
+        inputs, and the logits of the output layer.
+        """
+        activations = [np.asarray(data, dtype=self.dtype)]
+        for weights, biases in zip(self.weights[:-1], self.biases[:-1]):
+            activations.append(np.maximum(activations[-1] @ weights + biases, 0))
+        return activations, activations[-1] @ self.weights[-1] + self.biases[-1]
+
+    @staticmethod
+    def log_softmax(logits):
+        shifted = logits - logits.max(axis=-1, keepdims=True)
+        return shifted - np.log(np.exp(shifted).sum(axis=-1, keepdims=True))
+
+    def train_on_batch(self, data, labels) -> float:
+        """
+        Takes one SGD step on a batch.
+
+        :return: The mean loss of the batch before the step.
+        """
+        activations, logits = self.forward(data)
+        log_probabilities = self.log_softmax(logits)
+        labels = np.asarray(labels, dtype=self.dtype)
+        loss = float(-(labels * log_probabilities).sum(axis=1).mean())
+
+        # The gradient of softmax followed by crossentropy with respect to the logits.
+        gradient = (np.exp(log_probabilities) - labels) / len(labels)
+
+        for layer in reversed(range(len(self.weights))):
+            weights_gradient = activations[layer].T @ gradient
+            biases_gradient = gradient.sum(axis=0)
+            if layer > 0:
+                gradient = (gradient @ self.weights[layer].T) * (activations[layer] > 0)
+
+            self.weights[layer] -= self.learning_rate * weights_gradient
+            self.biases[layer] -= self.learning_rate * biases_gradient
+
+        return loss
+
+    def fit(self, data, labels=None, epochs: int = 5, batch_size: int = 32,
+            steps_per_epoch: int = None, validation_data=None, tolerance: float = 0.0,
+            patience: int = 1):
+        """
+        Trains the model. Like Keras' EarlyStopping, training stops early if validation data is
+        given and the validation loss has not improved by more than the tolerance for patience
+        epochs in a row.
+
+        :param data: The training data, or an iterator of batches of data and labels such as a
+        TrainingDataStream or CompactDataFeed.
+        :param labels: The training labels, or None if data is an iterator of batches.
+        :param epochs: The number of passes over the training data.
+        :param batch_size: The number of dilemmas in each batch. Ignored for iterators.
+        :param steps_per_epoch: The number of batches in each epoch. Defaults to the
+        steps_per_epoch of the iterator.
+        :param validation_data: A tuple of the validation data and labels, or None to train for
+        every epoch.
+        :param tolerance: The least decrease of the validation loss which counts as improvement.
+        :param patience: The number of epochs without improvement to stop after.
+        :return: The mean loss of each epoch trained.
+        """
+        if labels is None and steps_per_epoch is None:
+            steps_per_epoch = data.steps_per_epoch
+
+        history = []
+        best_loss = np.inf
+        epochs_without_improvement = 0
+        for _ in range(epochs):
+            if labels is None:
+                losses = [self.train_on_batch(*next(data)) for _ in range(steps_per_epoch)]
+            else:
+                order = self.rng.permutation(len(data))
+                losses = [self.train_on_batch(data[rows], labels[rows])
+                          for rows in (np.sort(order[start:start + batch_size])
+                                       for start in range(0, len(order), batch_size))]
+            history.append(float(np.mean(losses)))
+
+            if validation_data is not None:
+                validation_loss = self.evaluate(*validation_data)[0]
+                if validation_loss < best_loss - tolerance:
+                    best_loss = validation_loss
+                    epochs_without_improvement = 0
+                else:
+                    epochs_without_improvement += 1
+                    if epochs_without_improvement >= patience:
+                        break
+        return history
+
+    def predict(self, data, batch_size: int = 1024):
+        """
+        :return: The probability of each class for each row of the data.
+        """
+        return np.concatenate([
+            np.exp(self.log_softmax(self.forward(data[start:start + batch_size])[1]))
+            for start in range(0, len(data), batch_size)
+        ])
+
+    def evaluate(self, data, labels, batch_size: int = 1024):
+        """
+        :return: A tuple of the mean loss (see categorical_crossentropy) and the categorical
+        accuracy over the data.
+        """
+        loss = 0.0
+        correct = 0
+        for start in range(0, len(data), batch_size):
+            probabilities = self.predict(data[start:start + batch_size], batch_size)
+            batch_labels = np.asarray(labels[start:start + batch_size], dtype=self.dtype)
+            loss += float(categorical_crossentropy(probabilities, batch_labels).sum())
+            correct += int((probabilities.argmax(axis=1) == batch_labels.argmax(axis=1)).sum())
+        return loss / len(data), correct / len(data)
+
+
+def predict_stacked(weights, data, batch_size: int = 1024, dtype=np.float32):
+    """
+    Runs many models of the same architecture at once, as one batched matrix multiplication per
+    layer instead of one per model.
+
+    :param weights: The weights of each model, as get_weights returns them (Keras models' weights
+    have the same layout).
+    :param data: The inputs.
+    :param batch_size: The number of rows of the data to run at a time.
+    :param dtype: The dtype of the computation.
+    :return: The probability of each class for each row of the data, for each model, an array of
+    shape (models, rows, classes).
+    """
+    stacked = [np.stack(arrays).astype(dtype, copy=False) for arrays in zip(*weights)]
+
+    # Shape (models, inputs, outputs) and (models, 1, outputs) for each layer.
+    stacked_weights = stacked[0::2]
+    stacked_biases = [biases[:, np.newaxis] for biases in stacked[1::2]]
+
+    probabilities = []
+    for start in range(0, len(data), batch_size):
+        activations = np.asarray(data[start:start + batch_size], dtype=dtype)
+        for layer, (layer_weights, biases) in enumerate(zip(stacked_weights, stacked_biases)):
+            activations = activations @ layer_weights + biases
+            if layer < len(stacked_weights) - 1:
+                activations = np.maximum(activations, 0)
+
+        probabilities.append(np.exp(NumpyMLP.log_softmax(activations)))
+    return np.concatenate(probabilities, axis=1)
+
+
+class TestNumpyMLP(unittest.TestCase):
+
+    def testGradientMatchesFiniteDifferences(self):
+        rng = np.random.default_rng(0)
+        data = rng.integers(0, 2, (8, 6)).astype(np.float64)
+        labels = np.eye(2)[rng.integers(0, 2, 8)]
+
+        model = NumpyMLP([6, 5, 4, 2], learning_rate=1.0, seed=1, dtype=np.float64)
+        weights = [w.copy() for w in model.weights]
+        model.train_on_batch(data, labels)
+        # With a learning rate of 1 the step is the negative gradient.
+        gradient = weights[0] - model.weights[0]
+
+        def loss(first_weights):
+            other = NumpyMLP([6, 5, 4, 2], seed=1, dtype=np.float64)
+            other.weights[0] = first_weights
+            return other.evaluate(data, labels)[0]
+
+        epsilon = 1e-6
+        for i, j in [(0, 0), (2, 3), (5, 4)]:
+            step = np.zeros_like(weights[0])
+            step[i, j] = epsilon
+            numeric = (loss(weights[0] + step) - loss(weights[0] - step)) / (2 * epsilon)
+            self.assertAlmostEqual(gradient[i, j], numeric, places=5)
+
+    def testLearnsTrainingData(self):
+        from generate_data_pgmpy import DilemmaGenerator
+        from generate_training_data import generate_sharded_training_data
+
+        generators = [DilemmaGenerator(option_vals=[[0.4, 0.6]], jaywalking_vals=[[1, 0], [0, 1]],
+                                       cache=None)]
+        data, labels = generate_sharded_training_data(generators, 3, 2000, seed=1)
+
+        model = NumpyMLP([data.shape[1], 64, 32, 2], seed=1)
+        history = model.fit(data[:1500], labels[:1500], epochs=5)
+        loss, accuracy = model.evaluate(data[1500:], labels[1500:])
+
+        self.assertLess(history[-1], history[0])
+        self.assertGreater(accuracy, 0.8)
+        self.assertEqual(model.predict(data[:10]).shape, (10, 2))
+
+    def testSetWeights(self):
+        model = NumpyMLP([6, 5, 2], seed=1)
+        other = NumpyMLP([6, 5, 2], seed=2)
+        other.set_weights(model.get_weights())
+
+        data = np.eye(6)
+        self.assertTrue(np.array_equal(model.predict(data), other.predict(data)))
+
+    def testPredictStacked(self):
+        models = [NumpyMLP([6, 5, 4, 2], seed=seed) for seed in range(3)]
+        data = np.random.default_rng(0).integers(0, 2, (10, 6))
+
+        probabilities = predict_stacked([model.get_weights() for model in models], data,
+                                        batch_size=4)
+
+        self.assertEqual(probabilities.shape, (3, 10, 2))
+        for model, model_probabilities in zip(models, probabilities):
+            self.assertTrue(np.allclose(model.predict(data), model_probabilities, atol=1e-6))
+
+    def testStopsWhenValidationLossPlateaus(self):
+        rng = np.random.default_rng(0)
+        data = rng.integers(0, 2, (64, 6))
+        labels = np.eye(2)[rng.integers(0, 2, 64)]
+
+        model = NumpyMLP([6, 5, 4, 2], seed=1)
+        # Nothing counts as improvement with an infinite tolerance.
+        history = model.fit(data, labels, epochs=10, validation_data=(data, labels),
+                            tolerance=np.inf, patience=2)
+        self.assertEqual(len(history), 2)
+
+        model.initialize()
+        history = model.fit(data, labels, epochs=10, validation_data=(data, labels),
+                            tolerance=-np.inf)
+        self.assertEqual(len(history), 10)
+
+    def testLossIsClippedLikeKeras(self):
+        probabilities = np.array([[1.0, 0.0], [0.25, 0.75]])
+        labels = np.array([[0, 1], [0, 1]])
+
+        self.assertTrue(np.allclose(categorical_crossentropy(probabilities, labels),
+                                    [-np.log(epsilon), -np.log(0.75)]))
+
+    @unittest.skipUnless(importlib.util.find_spec("keras") is not None, "Keras is not installed")
+    def testMatchesKerasAccuracy(self):
+        from generate_data_pgmpy import DilemmaGenerator
+        from generate_training_data import generate_sharded_training_data
+        from manage_data import TrainMetadata
+        from train_ai_iteration import evaluate_model, train_iteration
+
+        generators = [DilemmaGenerator(option_vals=[[0.4, 0.6]], jaywalking_vals=[[1, 0], [0, 1]],
+                                       cache=None)]
+        data, labels = generate_sharded_training_data(generators, 3, 3000, seed=1)
+        metadata = TrainMetadata(2000, 3)
+
+        # Both backends train the same architecture with the same optimizer for 5 epochs.
+        accuracies = {}
+        for backend in ["keras", "numpy"]:
+            model, _ = train_iteration(data[:2000], labels[:2000], metadata, backend)
+            accuracies[backend] = evaluate_model(model, data[2000:], labels[2000:], metadata)[1]
+
+        self.assertAlmostEqual(accuracies["numpy"], accuracies["keras"], delta=0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# This file is part of MoralAI.
+#
+# MoralAI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MoralAI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MoralAI.  If not, see <https://www.gnu.org/licenses/>.
+import getopt
+import json
+import os
+import sys
+import tempfile
+import unittest
+from enum import Enum
+
+import numpy as np
+
+from manage_data import CheckpointStore
+from model import DilemmaBatch, attribute_indices, attribute_names, count_jaywalkers_per_option
+from numpy_mlp import categorical_crossentropy, predict_stacked
+
+usage = "Usage: reevaluate.py -c <checkpoint_directory> -i <test_file_prefix> " \
+        "[-i <test_file_prefix>...] [-m <metric>...]"
+
+
+class EvaluationSet:
+
+    def __init__(self, data, labels, metadata):
+        """
+        A test set with what metrics need to know about it worked out once for all the models
+        evaluated against it.
+
+        :param data: The test data, as bit vectors.
+        :param labels: The test labels.
+        :param metadata: The test set's TrainMetadata.
+        """
+        self.data = data
+        self.labels = labels
+        self.metadata = metadata
+        self.label_indices = np.argmax(labels, axis=1)
+
+        num_options = labels.shape[1]
+        self.jaywalkers = count_jaywalkers_per_option(data, num_options,
+                                                      metadata.max_num_people_per_option)
+        self.batch = DilemmaBatch.from_export(data, num_options,
+                                              metadata.max_num_people_per_option)
+
+
+def loss(predictions, test_set: EvaluationSet):
+    return float(categorical_crossentropy(predictions, test_set.labels).mean())
+
+
+def accuracy(predictions, test_set: EvaluationSet):
+    return float((np.argmax(predictions, axis=1) == test_set.label_indices).mean())
+
+
+def num_jaywalkers(predictions, test_set: EvaluationSet):
+    return int(test_set.jaywalkers.sum())
+
+
+def prob_jaywalking_when_wrong(predictions, test_set: EvaluationSet):
+    prediction_indices = np.argmax(predictions, axis=1)
+    wrong = prediction_indices != test_set.label_indices
+    return int(test_set.jaywalkers[wrong, prediction_indices[wrong]].sum()) / \
+        num_jaywalkers(predictions, test_set)
+
+
+def error_rate_by(attribute: str):
+    """
+    :param attribute: The name of an attribute, one of attribute_names.
+    :return: A metric which gives, for each value of the attribute, the fraction of the dilemmas
+    with anyone of that value in them which the model got wrong. It is None for values nobody in
+    the test set has.
+    """
+    def metric(predictions, test_set: EvaluationSet):
+        wrong = np.argmax(predictions, axis=1) != test_set.label_indices
+
+        rates = {}
+        for value in attribute_indices[attribute_names.index(attribute)]:
+            if value is None:
+                continue
+
+            has_value = test_set.batch.count(attribute, value).sum(axis=1) > 0
+            name = value.name if isinstance(value, Enum) else str(value)
+            rates[name] = float(wrong[has_value].mean()) if has_value.any() else None
+        return rates
+
+    return metric
+
+
+# The metrics reevaluate can compute, by name. Each takes the predictions of a model and the
+# EvaluationSet and returns a JSON value.
+metrics = dict({
+    "loss": loss,
+    "accuracy": accuracy,
+    "num_jaywalkers": num_jaywalkers,
+    "prob_jaywalking_when_wrong": prob_jaywalking_when_wrong
+}, **{"error_rate_by_" + attribute: error_rate_by(attribute) for attribute in attribute_names})
+
+
+def reevaluate(checkpoints: CheckpointStore, test_set: EvaluationSet, metric_names=None,
+               model_batch_size: int = 16, batch_size: int = 1024):
+    """
+    Computes metrics of every model in a checkpoint store against a test set, without training
+    anything. Models are run in batches (see predict_stacked).
+
+    :param checkpoints: The store of the models.
+    :param test_set: The test set.
+    :param metric_names: The names of the metrics to compute (see metrics), or None for all of
+    them.
+    :param model_batch_size: The number of models to run at a time.
+    :param batch_size: The number of dilemmas to run at a time.
+    :return: For each model, its cell, repeat and seed, the run which trained it, its backend,
+    whether it was warm started and its metrics.
+    """
+    if metric_names is None:
+        metric_names = list(metrics)
+
+    # Only models of the same architecture can be run together.
+    by_architecture = {}
+    for entry in checkpoints.entries():
+        by_architecture.setdefault(tuple(entry.get("layer_sizes", [])), []).append(entry)
+
+    results = []
+    for entries in by_architecture.values():
+        for start in range(0, len(entries), model_batch_size):
+            batch_entries = entries[start:start + model_batch_size]
+            predictions = predict_stacked([checkpoints.load(entry["key"])
+                                           for entry in batch_entries], test_set.data,
+                                          batch_size)
+
+            for entry, model_predictions in zip(batch_entries, predictions):
+                result = {name: entry[name]
+                          for name in ["option_cpd", "jaywalking_cpd", "repeat", "seed"]}
+                for name in ["run", "backend", "warm_start", "warm_start_epochs"]:
+                    result[name] = entry.get(name)
+                for name in metric_names:
+                    result[name] = metrics[name](model_predictions, test_set)
+                results.append(result)
+    return results
+
+
+def main(argv):
+    from train_ai_iteration import load_test_set
+
+    try:
+        opts, args = getopt.getopt(argv, "c:i:m:")
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+
+    checkpoint_directory = None
+    test_data_filenames = []
+    metric_names = None
+    for opt, arg in opts:
+        if opt == "-c":
+            checkpoint_directory = arg
+        elif opt == "-i":
+            test_data_filenames.append(arg)
+        elif opt == "-m":
+            if arg not in metrics:
+                print("Unknown metric: " + arg + ". Metrics: " + ", ".join(metrics))
+                sys.exit(2)
+            metric_names = (metric_names or []) + [arg]
+
+    if checkpoint_directory is None or len(test_data_filenames) == 0:
+        print(usage)
+        sys.exit(2)
+
+    checkpoints = CheckpointStore(checkpoint_directory)
+    for test_data_filename in test_data_filenames:
+        results = reevaluate(checkpoints, EvaluationSet(*load_test_set(test_data_filename)),
+                             metric_names)
+        with open("reevaluated results for " + os.path.basename(test_data_filename), "w") as f:
+            f.write(json.dumps(results))
+
+
+class TestReevaluate(unittest.TestCase):
+
+    def testMatchesModels(self):
+        from generate_data_pgmpy import DilemmaGenerator
+        from generate_training_data import generate_sharded_training_data
+        from manage_data import TrainMetadata
+        from numpy_mlp import NumpyMLP
+
+        generators = [DilemmaGenerator(option_vals=[[0.4, 0.6]], cache=None),
+                      DilemmaGenerator(option_vals=[[0.6, 0.4]], cache=None)]
+        data, labels = generate_sharded_training_data(generators, 3, 50, seed=1)
+        test_set = EvaluationSet(data, labels, TrainMetadata(50, 3))
+
+        models = [NumpyMLP([data.shape[1], 8, 2], seed=seed) for seed in range(3)]
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoints = CheckpointStore(directory)
+            for repeat, model in enumerate(models):
+                checkpoints.save([0.4, 0.6], [0.5, 0.5], repeat, 1, model.get_weights(), "numpy",
+                                 2, layer_sizes=model.layer_sizes, warm_start=repeat > 0)
+
+            results = reevaluate(checkpoints, test_set, model_batch_size=2)
+
+        self.assertEqual([result["repeat"] for result in results], [0, 1, 2])
+        for model, result in zip(models, results):
+            model_loss, model_accuracy = model.evaluate(data, labels)
+            self.assertAlmostEqual(result["loss"], model_loss, places=5)
+            self.assertAlmostEqual(result["accuracy"], model_accuracy)
+            self.assertEqual(result["backend"], "numpy")
+            self.assertEqual(result["warm_start_epochs"], 2)
+            self.assertEqual(result["warm_start"], result["repeat"] > 0)
+            self.assertEqual(set(result["error_rate_by_race"]),
+                             {"white", "black", "asian", "native_american", "other_race"})
+            self.assertEqual(set(result["error_rate_by_jaywalking"]), {"True", "False"})
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -15,54 +15,523 @@
 # along with MoralAI.  If not, see <https://www.gnu.org/licenses/>.
 import getopt
 import json
+import multiprocessing
+import os
 import sys
+import tempfile
+import unittest
+from unittest import mock
 
 import numpy as np
 
-from train_ai_iteration import train_and_test
+from manage_data import CheckpointStore, SharedArrays, TrainingDataCache
+from train_ai_iteration import AdaptiveEpochs, WarmStart
+
+usage = "Usage: train_ai.py -i <test_file_prefix> [-i <test_file_prefix>...] [-w <workers>] " \
+        "[-t <threads_per_worker>] [--resume] [--cache] [--ensemble] [--backend keras|numpy] " \
+        "[--adaptive [--max-epochs <epochs>]] [--warm-start] [--warm-epochs <epochs>] " \
+        "[--checkpoints <directory>] [--restart]"
+
+
+class SweepJournal:
+
+    def __init__(self, filename: str, resume: bool = False, restart: bool = False):
+        """
+        A journal of the results of finished sweep cells, one JSON line per cell. Every line is
+        written with a single append and flushed to disk, so a crash loses at most the line being
+        written, which is ignored when the journal is read back.
+
+        :param filename: The journal file.
+        :param resume: Whether to keep the cells already in the journal.
+        :param restart: Whether to start the journal over, discarding the cells already in it.
+        :raises ValueError: If the journal already has cells in it but neither resume nor restart
+        is given, so forgetting --resume never throws away the progress of a sweep.
+        """
+        self.filename = filename
+        self.completed = {}
+
+        if resume and os.path.exists(filename):
+            with open(filename, "r+") as f:
+                lines = f.read().split("\n")
+
+                # Drop a partially written last line so the next record starts on a new line.
+                f.truncate(len("\n".join(lines[:-1]).encode()) + (1 if len(lines) > 1 else 0))
+
+            for line in lines[:-1]:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.completed[tuple(entry["cell"])] = entry["results"]
+        elif restart or not os.path.exists(filename) or os.path.getsize(filename) == 0:
+            open(filename, "w").close()
+        else:
+            raise ValueError(filename + " already has results in it. Pass --resume to continue "
+                                        "the sweep or --restart to start it over.")
+
+    def record(self, cell, results):
+        """
+        Records the results of a finished cell.
+
+        :param cell: The cell's key, a tuple of JSON values.
+        :param results: The cell's results.
+        """
+        line = (json.dumps({"cell": list(cell), "results": results}) + "\n").encode()
+
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        self.completed[tuple(cell)] = results
+
+
+def grid():
+    """
+    :return: The option CPDs and the jaywalking CPDs of the sweep, in order.
+    """
+    option_cpds = [[first_option_probability, 1 - first_option_probability]
+                   for first_option_probability in np.linspace(0, 1, 10)]
+    jaywalking_cpds = [[jaywalking_probability, 1 - jaywalking_probability]
+                       for jaywalking_probability in np.append(np.linspace(0, 3 / 10, 5),
+                                                               np.linspace(7 / 10, 1, 5))]
+    return option_cpds, jaywalking_cpds
+
+
+def serpentine(num_rows: int, num_columns: int):
+    """
+    :return: The (row, column) of every cell of a grid, in an order which only ever steps to a
+    neighbouring cell: along each row, turning around at its end to come back along the next.
+    """
+    return [(row, column if row % 2 == 0 else num_columns - 1 - column)
+            for row in range(num_rows) for column in range(num_columns)]
+
+
+# The environment variables which limit the threads of TensorFlow and the BLAS under numpy.
+thread_variables = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                    "TF_NUM_INTRAOP_THREADS", "TF_NUM_INTEROP_THREADS"]
+
+
+def limit_threads(threads: int, backend: str = "keras"):
+    """
+    Limits the number of threads TensorFlow (and the BLAS under numpy) use in this process. This
+    must run before TensorFlow runs anything.
+
+    :param threads: The number of intra-op and inter-op threads.
+    :param backend: The backend models are trained with. TensorFlow is only imported for keras.
+    """
+    for variable in thread_variables:
+        os.environ[variable] = str(threads)
+
+    if backend != "keras":
+        return
+
+    import tensorflow as tf
+    if hasattr(tf, "config") and hasattr(tf.config, "threading"):
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+    else:
+        from keras import backend as K
+        K.set_session(tf.Session(config=tf.ConfigProto(
+            intra_op_parallelism_threads=threads,
+            inter_op_parallelism_threads=threads
+        )))
+
+
+# The test sets of the sweep, loaded once per process.
+test_sets = None
+
+# The shared memory blocks backing test_sets in worker processes.
+test_set_blocks = None
+
+
+def init_worker(threads: int, backend: str, test_set_handle, test_metadata):
+    """
+    Prepares a sweep worker process: limits its threads and attaches to the test sets published
+    by the main process.
+    """
+    global test_sets, test_set_blocks
+
+    limit_threads(threads, backend)
+
+    arrays, test_set_blocks = SharedArrays.attach(test_set_handle)
+    test_sets = [(arrays[2 * k], arrays[2 * k + 1], metadata)
+                 for k, metadata in enumerate(test_metadata)]
+
+
+def train_cell(args, warm_start: WarmStart = None):
+    from train_ai_iteration import train_and_test_many
+
+    test_data_filenames, option_index, jaywalking_index, option_cpd, jaywalking_cpd, options = args
+    return option_index, jaywalking_index, train_and_test_many(test_data_filenames, option_cpd,
+                                                               jaywalking_cpd,
+                                                               test_sets=test_sets,
+                                                               warm_start=warm_start, **options)
+
+
+def train_chain(args):
+    """
+    Trains cells one after another, each starting from the weights the one before it ended with
+    if warm_start_epochs is given and the two are neighbours in the grid. Each cell's results are
+    recorded in the journals as soon as it finishes, even in a worker process: journal lines are
+    written with a single append, so workers never interleave them.
+
+    :return: The results of each cell (see train_cell).
+    """
+    cells, warm_start_epochs, journals = args
+    warm_start = None if warm_start_epochs is None else WarmStart(warm_start_epochs)
+
+    chain_results = []
+    previous = None
+    for cell in cells:
+        if warm_start is not None and previous is not None and \
+                abs(cell[1] - previous[1]) + abs(cell[2] - previous[2]) != 1:
+            # The cells in between were finished before the sweep was resumed, so there are no
+            # weights of a neighbour to start from.
+            warm_start.reset()
+
+        option_index, jaywalking_index, cell_results = train_cell(cell, warm_start)
+        if journals is not None:
+            for journal, result in zip(journals, cell_results):
+                journal.record((option_index, jaywalking_index), result)
+
+        chain_results.append((option_index, jaywalking_index, cell_results))
+        previous = cell
+    return chain_results
+
+
+def run_sweep(test_data_filenames, workers: int = 1, threads: int = None, journals=None,
+              cache: TrainingDataCache = None, ensemble: bool = False, backend: str = "keras",
+              adaptive=None, warm_start_epochs: int = None, checkpoints: CheckpointStore = None):
+    """
+    Trains every cell of the sweep and tests it against every test set. Each cell's models are
+    trained once for all the test sets.
+
+    :param test_data_filenames: The test data to test against.
+    :param workers: The number of processes to train cells in. 1 trains in this process.
+    :param threads: The number of TensorFlow threads per worker. Defaults to the number of CPUs
+    divided by the number of workers.
+    :param journals: A SweepJournal for each test set to record each cell's results in as soon as
+    it finishes. Cells already in every journal are not trained again.
+    :param cache: The cache to reuse each cell's training data from, or None to always generate it.
+    :param ensemble: Whether to train each cell's repeats at once (see train_ensemble_iteration).
+    :param backend: The backend to train with, "keras" or "numpy" (see train_iteration).
+    :param adaptive: The AdaptiveEpochs to train each cell's models with, or None to train them
+    for 5 epochs.
+    :param warm_start_epochs: The most epochs to fine-tune each cell's models for, starting from
+    the weights of the cell before it in a serpentine walk through the grid, or None to train
+    every cell from random weights. With several workers the walk is split into a chain per
+    worker. The first cell of each chain, and every cell after one which was already in the
+    journals, starts from random weights.
+    :param checkpoints: The store to save the weights of every model trained in (see
+    reevaluate.py), or None to not save them.
+    :return: The results for each test set, in the layout of the dense results file.
+    """
+    global test_sets
+
+    from train_ai_iteration import load_test_set
+
+    option_cpds, jaywalking_cpds = grid()
+
+    results = [{} for _ in test_data_filenames]
+    if journals is not None:
+        for test_results, journal in zip(results, journals):
+            test_results.update(journal.completed)
+
+    options = {"cache": cache, "ensemble": ensemble, "backend": backend, "adaptive": adaptive,
+               "checkpoints": checkpoints}
+    cells = [(test_data_filenames, i, j, option_cpds[i], jaywalking_cpds[j], options)
+             for i, j in serpentine(len(option_cpds), len(jaywalking_cpds))
+             if any((i, j) not in test_results for test_results in results)]
+
+    if warm_start_epochs is None:
+        chains = [[cell] for cell in cells]
+    else:
+        # Neighbouring cells differ only a little, so each cell is fine-tuned from the weights of
+        # the one before it.
+        chains = [[cells[k] for k in chain]
+                  for chain in np.array_split(np.arange(len(cells)), workers) if len(chain) > 0]
+
+    def finish_cell(option_index, jaywalking_index, cell_results):
+        for k, result in enumerate(cell_results):
+            results[k][(option_index, jaywalking_index)] = result
+
+    if len(cells) > 0:
+        # Read the test sets once for the whole sweep instead of once per cell.
+        test_sets = [load_test_set(test_data_filename)
+                     for test_data_filename in test_data_filenames]
+
+    if workers == 1:
+        if threads is not None:
+            limit_threads(threads, backend)
+
+        for cell_result in train_chain((cells, warm_start_epochs, journals)):
+            finish_cell(*cell_result)
+    elif len(cells) > 0:
+        if threads is None:
+            threads = max(1, multiprocessing.cpu_count() // workers)
+
+        test_arrays = [array for test_data, test_labels, _ in test_sets
+                       for array in (test_data, test_labels)]
+        test_metadata = [metadata for _, _, metadata in test_sets]
+
+        # Workers import numpy before init_worker runs, so they take the BLAS thread limit from
+        # the environment they inherit.
+        for variable in thread_variables:
+            os.environ[variable] = str(threads)
+
+        # Publish the test sets in shared memory so workers use them without copying them. Spawn
+        # fresh workers so none of them inherit TensorFlow state from this process.
+        with SharedArrays(test_arrays) as shared_test_sets, \
+                multiprocessing.get_context("spawn").Pool(
+                    workers, initializer=init_worker,
+                    initargs=(threads, backend, shared_test_sets.handle, test_metadata)) as pool:
+            for chain_results in pool.imap_unordered(
+                    train_chain, [(chain, warm_start_epochs, journals) for chain in chains]):
+                for cell_result in chain_results:
+                    finish_cell(*cell_result)
+
+    test_sets = None
+
+    return [{
+        "option_level_results": [{
+            "option_cpd": option_cpd,
+            "jaywalking_level_results": [{
+                "jaywalking_cpd": jaywalking_cpd,
+                "results": test_results[(i, j)]
+            } for j, jaywalking_cpd in enumerate(jaywalking_cpds)]
+        } for i, option_cpd in enumerate(option_cpds)]
+    } for test_results in results]
 
 
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, "i:")
+        opts, args = getopt.getopt(argv, "i:w:t:", ["resume", "restart", "cache", "ensemble",
+                                                      "backend=", "adaptive", "max-epochs=",
+                                                      "warm-start", "warm-epochs=",
+                                                      "checkpoints="])
     except getopt.GetoptError:
-        print("Usage: train_ai.py -i <test_file_prefix>")
+        print(usage)
         sys.exit(2)
 
-    test_data_filename = None
+    test_data_filenames = []
+    workers = 1
+    threads = None
+    resume = False
+    restart = False
+    cache = None
+    ensemble = False
+    backend = "keras"
+    adaptive = None
+    max_epochs = None
+    warm_start_epochs = None
+    checkpoints = None
     for opt, arg in opts:
         if opt == "-i":
-            test_data_filename = arg
+            # Every test set given is tested against the same models.
+            test_data_filenames.append(arg)
+        elif opt == "-w":
+            workers = int(arg)
+        elif opt == "-t":
+            threads = int(arg)
+        elif opt == "--resume":
+            resume = True
+        elif opt == "--restart":
+            restart = True
+        elif opt == "--cache":
+            # Reuse each cell's training data across sweeps of different test sets and reruns.
+            cache = TrainingDataCache()
+        elif opt == "--ensemble":
+            ensemble = True
+        elif opt == "--backend":
+            # The numpy backend trains without importing TensorFlow.
+            backend = arg
+        elif opt == "--adaptive":
+            # Easy cells stop training as soon as their validation loss plateaus.
+            adaptive = AdaptiveEpochs()
+        elif opt == "--max-epochs":
+            max_epochs = int(arg)
+        elif opt == "--warm-start":
+            warm_start_epochs = warm_start_epochs or WarmStart().epochs
+        elif opt == "--warm-epochs":
+            warm_start_epochs = int(arg)
+        elif opt == "--checkpoints":
+            # Keep every trained model, so new metrics don't need the sweep to be run again.
+            checkpoints = CheckpointStore(arg)
 
-    if test_data_filename is None:
+    if len(test_data_filenames) == 0:
         print("-i argument required")
-        print("Usage: train_ai.py -i <test_file_prefix>")
+        print(usage)
+        sys.exit(2)
+    elif max_epochs is not None and adaptive is None:
+        print("--max-epochs requires --adaptive")
+        print(usage)
         sys.exit(2)
 
-    results_filename = "dense results for " + test_data_filename
+    if max_epochs is not None:
+        adaptive.max_epochs = max_epochs
 
-    option_level_results = []
-    for first_option_probability in np.linspace(0, 1, 10):
-        option_cpd = [first_option_probability, 1 - first_option_probability]
+    # Warm started sweeps keep their results apart, so they can be compared with cold ones.
+    prefix = "" if warm_start_epochs is None else "warm start "
 
-        jaywalking_level_results = []
-        for jaywalking_probability in np.append(np.linspace(0, 3 / 10, 5),
-                                                np.linspace(7 / 10, 1, 5)):
-            jaywalking_cpd = [jaywalking_probability, 1 - jaywalking_probability]
-            jaywalking_level_results.append({
-                "jaywalking_cpd": jaywalking_cpd,
-                "results": train_and_test(test_data_filename, option_cpd, jaywalking_cpd)
-            })
+    # The journals and results are written to the working directory, named after the test sets.
+    names = [os.path.basename(test_data_filename) for test_data_filename in test_data_filenames]
 
-        option_level_results.append({
-            "option_cpd": option_cpd,
-            "jaywalking_level_results": jaywalking_level_results
-        })
+    # Each cell's results go to the journals as soon as the cell finishes, so a sweep which is
+    # interrupted can be resumed with --resume.
+    try:
+        journals = [SweepJournal(prefix + "sweep journal for " + name, resume, restart)
+                    for name in names]
+    except ValueError as e:
+        print(e)
+        sys.exit(2)
+
+    results = run_sweep(test_data_filenames, workers, threads, journals, cache, ensemble,
+                        backend, adaptive, warm_start_epochs, checkpoints)
+
+    # The journals hold every cell, so the results of a resumed sweep are complete and replace
+    # any written before.
+    for name, test_results in zip(names, results):
+        with open(prefix + "dense results for " + name, "w") as f:
+            f.write(json.dumps(test_results))
+
+
+def fake_train_and_test_many(test_data_filenames, option_cpd, jaywalking_cpd, test_sets=None,
+                             **kwargs):
+    """
+    Stands in for train_ai_iteration.train_and_test_many in tests: each test set's results are
+    the cell's CPDs and the name of the test set.
+    """
+    return [[{"option_cpd": option_cpd, "jaywalking_cpd": jaywalking_cpd, "test_set": test_set}]
+            for test_set, _, _ in test_sets]
+
+
+class TestSweepJournal(unittest.TestCase):
+
+    def testResume(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "journal")
+            journal = SweepJournal(filename)
+            journal.record((0, 1), [{"accuracy": 0.5}])
+            journal.record((2, 3), [{"accuracy": 0.75}])
+            with open(filename, "a") as f:
+                f.write('{"cell": [4, 5], "res')
+
+            journal = SweepJournal(filename, resume=True)
+            self.assertEqual(journal.completed, {(0, 1): [{"accuracy": 0.5}],
+                                                 (2, 3): [{"accuracy": 0.75}]})
+
+            # The partial line is gone, so the next record is read back too.
+            journal.record((4, 5), [])
+            self.assertEqual(len(SweepJournal(filename, resume=True).completed), 3)
+
+    def testRefusesToDiscardResults(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "journal")
+            SweepJournal(filename).record((0, 1), [])
+
+            with self.assertRaises(ValueError):
+                SweepJournal(filename)
+            self.assertEqual(len(SweepJournal(filename, resume=True).completed), 1)
+
+            self.assertEqual(SweepJournal(filename, restart=True).completed, {})
+            self.assertEqual(os.path.getsize(filename), 0)
+            SweepJournal(filename)
+
+
+class TestSweep(unittest.TestCase):
+
+    def testSerpentineStepsToNeighbours(self):
+        cells = serpentine(3, 4)
+
+        self.assertEqual(sorted(cells), [(i, j) for i in range(3) for j in range(4)])
+        for (i, j), (next_i, next_j) in zip(cells, cells[1:]):
+            self.assertEqual(abs(next_i - i) + abs(next_j - j), 1)
+
+    @mock.patch("train_ai_iteration.load_test_set", lambda name: (name, None, None))
+    @mock.patch("train_ai_iteration.train_and_test_many", fake_train_and_test_many)
+    def testRunSweep(self):
+        option_cpds, jaywalking_cpds = grid()
+
+        with tempfile.TemporaryDirectory() as directory:
+            journals = [SweepJournal(os.path.join(directory, name)) for name in ["a", "b"]]
+            # A cell finished before an interruption is not trained again.
+            journals[0].record((3, 4), [{"test_set": "journal"}])
+            journals[1].record((3, 4), [{"test_set": "journal"}])
+
+            results = run_sweep(["a", "b"], journals=journals)
+
+            for name, test_results, journal in zip(["a", "b"], results, journals):
+                option_level_results = test_results["option_level_results"]
+                self.assertEqual(len(option_level_results), len(option_cpds))
+                for i, option_level_result in enumerate(option_level_results):
+                    self.assertEqual(option_level_result["option_cpd"], option_cpds[i])
+                    for j, jaywalking_level_result in enumerate(
+                            option_level_result["jaywalking_level_results"]):
+                        self.assertEqual(jaywalking_level_result["jaywalking_cpd"],
+                                         jaywalking_cpds[j])
+                        result = jaywalking_level_result["results"][0]
+                        if (i, j) == (3, 4):
+                            self.assertEqual(result["test_set"], "journal")
+                        else:
+                            self.assertEqual(result, {"option_cpd": option_cpds[i],
+                                                      "jaywalking_cpd": jaywalking_cpds[j],
+                                                      "test_set": name})
+
+                self.assertEqual(len(SweepJournal(journal.filename, resume=True).completed),
+                                 len(option_cpds) * len(jaywalking_cpds))
+
+    def testWarmStartChain(self):
+        option_cpds, jaywalking_cpds = grid()
+        order = serpentine(len(option_cpds), len(jaywalking_cpds))
+        started_warm = {}
+
+        def train_and_test_many(test_data_filenames, option_cpd, jaywalking_cpd, test_sets=None,
+                                warm_start=None, **kwargs):
+            cell = (option_cpds.index(option_cpd), jaywalking_cpds.index(jaywalking_cpd))
+            if len(started_warm) == 3:
+                raise KeyboardInterrupt()
+
+            started_warm[cell] = len(warm_start.weights) > 0
+            warm_start.weights = {"cell": cell}
+            return [[{}]]
+
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch("train_ai_iteration.train_and_test_many", train_and_test_many):
+            journal = SweepJournal(os.path.join(directory, "journal"))
+            # The third cell of the walk was finished before the sweep was resumed.
+            journal.record(order[2], [{}])
+
+            cells = [([], i, j, option_cpds[i], jaywalking_cpds[j], {})
+                     for i, j in order[:2] + order[3:]]
+            with self.assertRaises(KeyboardInterrupt):
+                train_chain((cells, 2, [journal]))
+
+            # Cells are journalled as they finish, not when the whole chain does.
+            self.assertEqual(set(SweepJournal(journal.filename, resume=True).completed),
+                             set(order[:4]))
+
+        self.assertEqual(started_warm, {order[0]: False, order[1]: True, order[3]: False})
+
+    @mock.patch("train_ai_iteration.load_test_set", lambda name: (name, None, None))
+    @mock.patch("train_ai_iteration.train_and_test_many", fake_train_and_test_many)
+    def testMainRewritesResultsWhenResumed(self):
+        working_directory = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                for arguments in [[], ["--resume"]]:
+                    main(["-i", os.path.join("data", "test")] + arguments)
 
-    with open(results_filename, "a") as f:
-        f.write(json.dumps({
-            "option_level_results": option_level_results
-        }))
+                self.assertEqual(sorted(os.listdir(directory)),
+                                 ["dense results for test", "sweep journal for test"])
+                with open("dense results for test", "r") as f:
+                    results = json.loads(f.read())
+                self.assertEqual(len(results["option_level_results"]), len(grid()[0]))
+            finally:
+                os.chdir(working_directory)
 
 
 if __name__ == '__main__':
@@ -16,44 +16,383 @@
 import getopt
 import json
 import sys
+import time
+import unittest
 
-from keras import Sequential, losses, metrics
-from keras.layers import Dense
-from keras.utils import plot_model
+import numpy as np
 
 from generate_data_pgmpy import DilemmaGenerator
-from manage_data import TrainMetadata, preprocess_data_before_saving, read_data_from_file
-from model import create_dilemma_from_export
-
-
-def generate_training_data_in_memory(metadata: TrainMetadata, generators):
-    data, labels = preprocess_data_before_saving(metadata, generators)
+from generate_training_data import TrainingDataStream, CompactDataFeed
+from manage_data import TrainMetadata, TrainingDataCache, CheckpointStore, \
+    preprocess_data_before_saving, read_data_from_file
+from model import count_jaywalkers_per_option, compact_to_export
+from numpy_mlp import NumpyMLP, glorot_uniform
+
+usage = "Usage: train_ai_iteration.py -o <test_file_prefix> [-o <test_file_prefix>...] " \
+        "--ocpd <first_option_prob> --jcpd <jaywalking_prob> [--seed <seed>] " \
+        "[--workers <workers>] [--stream [--prefetch <batches>]] [--compact] [--symmetric] " \
+        "[--cache] [--ensemble] [--backend keras|numpy] [--plot-model <filename>] " \
+        "[--adaptive [--max-epochs <epochs>]] [--checkpoints <directory>]"
+
+# The backends models can be trained with. Keras is only imported if it is used.
+backends = ["keras", "numpy"]
+
+# The number of epochs models are trained for without AdaptiveEpochs, which is also the most
+# AdaptiveEpochs trains for by default.
+default_epochs = 5
+
+
+def generate_training_data_in_memory(metadata: TrainMetadata, generators, seed: int = None,
+                                     workers: int = 1, compact: bool = False,
+                                     symmetric: bool = False):
+    data, labels = preprocess_data_before_saving(metadata, generators, seed=seed, workers=workers,
+                                                 compact=compact, symmetric=symmetric)
     return data, labels, metadata
 
 
-def train_and_test_iteration(train_data, train_labels, train_metadata, test_data, test_labels,
-                             test_metadata):
-    model = Sequential()
+def input_dim_of(train_metadata):
+    # 22 elements per option, 2 options, each option padded to max number of people
+    return 22 * 2 * train_metadata.max_num_people_per_option
 
-    # 22 elements per option, 3 options, each option padded to max number of people
+
+def layer_sizes_of(train_metadata):
+    """
+    :return: The number of units of each layer of a model, starting with the input layer.
+    """
+    # Output layer dimension is 2 (class 1 is first_option and class 2 is second_option).
     output_dim = 2
-    input_dim = 22 * output_dim * train_metadata.max_num_people_per_option
+    input_dim = input_dim_of(train_metadata)
+    return [input_dim, input_dim, round((input_dim + output_dim) / 2), output_dim]
 
-    model.add(Dense(units=input_dim, activation='relu', input_dim=input_dim))
 
-    model.add(Dense(units=round((input_dim + output_dim) / 2), activation='relu'))
+def create_layers(layer_sizes):
+    """
+    :param layer_sizes: The number of units of each layer (see layer_sizes_of).
+    :return: The Keras layers of a new model, from the input layer to the output layer.
+    """
+    from keras.layers import Dense
+
+    input_dim, *units = layer_sizes
+    activations = ['relu'] * (len(units) - 1) + ['softmax']
+
+    return [Dense(units=units[0], activation=activations[0], input_dim=input_dim)] + \
+        [Dense(units=layer_units, activation=activation)
+         for layer_units, activation in zip(units[1:], activations[1:])]
 
-    # Output layer dimension is 2 (class 1 is first_option and class 2 is second_option).
-    model.add(Dense(units=output_dim, activation='softmax'))
 
-    plot_model(model, to_file="model.png", show_shapes=True, show_layer_names=True)
+def compile_model(model):
+    from keras import losses, metrics
 
     model.compile(loss=losses.categorical_crossentropy,
                   optimizer='sgd',
                   metrics=[metrics.categorical_accuracy])
 
-    model.fit(train_data, train_labels, epochs=5, batch_size=32)
 
+class AdaptiveEpochs:
+
+    def __init__(self, max_epochs: int = default_epochs, tolerance: float = 1e-3, patience: int = 1,
+                 validation_fraction: float = 0.05):
+        """
+        Trains until the loss on held out validation data stops improving, instead of for a fixed
+        number of epochs.
+
+        :param max_epochs: The most epochs to train for.
+        :param tolerance: The least decrease of the validation loss which counts as improvement.
+        :param patience: The number of epochs without improvement to stop after.
+        :param validation_fraction: The fraction of the training data to hold out for validation.
+        """
+        self.max_epochs = max_epochs
+        self.tolerance = tolerance
+        self.patience = patience
+        self.validation_fraction = validation_fraction
+
+    def split(self, data, labels, seed=None):
+        """
+        Holds out random rows of training data for validation.
+
+        :param seed: The seed for choosing the rows, or None to seed from fresh entropy.
+        :return: A tuple of the remaining data and labels and of the validation data and labels.
+        """
+        held_out = np.zeros(len(data), dtype=bool)
+        held_out[np.random.default_rng(seed).choice(
+            len(data), max(1, round(len(data) * self.validation_fraction)), replace=False)] = True
+        return (data[~held_out], labels[~held_out]), (data[held_out], labels[held_out])
+
+    def draw(self, batches):
+        """
+        Holds out batches of an endless stream of training data for validation.
+
+        :param batches: A TrainingDataStream or CompactDataFeed.
+        :return: A tuple of the validation data and labels.
+        """
+        drawn = [next(batches) for _ in range(
+            max(1, round(batches.steps_per_epoch * self.validation_fraction)))]
+        return (np.concatenate([data for data, _ in drawn]),
+                np.concatenate([labels for _, labels in drawn]))
+
+    def keras_callbacks(self):
+        from keras.callbacks import EarlyStopping
+
+        return [EarlyStopping(monitor="val_loss", min_delta=self.tolerance,
+                              patience=self.patience)]
+
+
+class WarmStart:
+
+    def __init__(self, epochs: int = 2):
+        """
+        The final weights of the models of the last cell trained, for the models of the next cell
+        to start from instead of from random weights. Models which start from weights are only
+        fine-tuned, so they train for fewer epochs.
+
+        :param epochs: The most epochs to fine-tune for.
+        """
+        self.epochs = epochs
+        self.weights = {}
+
+    def reset(self):
+        """
+        Forgets all weights, so the next cell starts from random weights.
+        """
+        self.weights = {}
+
+
+class ModelFactory:
+
+    def __init__(self, train_metadata, backend: str = "keras", ensemble_size: int = None):
+        """
+        Builds (and compiles) a model once and then hands out the same model with new initial
+        weights every time one is needed, so no time is spent building models over and over.
+
+        :param backend: The backend of the model, "keras" or "numpy" (see NumpyMLP).
+        :param ensemble_size: The number of branches of an ensemble (see
+        train_ensemble_iteration), or None for a single model.
+        """
+        self.layer_sizes = layer_sizes_of(train_metadata)
+        self.backend = backend
+        self.ensemble_size = ensemble_size
+        self.model = None
+        self.branches = None
+        self.rng = np.random.default_rng()
+
+    def build(self):
+        if self.backend == "numpy":
+            self.model = NumpyMLP(self.layer_sizes)
+            return
+
+        from keras import Sequential
+        from keras.layers import Input
+        from keras.models import Model
+
+        if self.ensemble_size is None:
+            self.model = Sequential(create_layers(self.layer_sizes))
+        else:
+            inputs = Input(shape=(self.layer_sizes[0],))
+
+            outputs = []
+            for _ in range(self.ensemble_size):
+                x = inputs
+                for layer in create_layers(self.layer_sizes):
+                    x = layer(x)
+                outputs.append(x)
+
+            self.model = Model(inputs=inputs, outputs=outputs)
+
+            # Each branch is a model of its own which shares its layers with the ensemble.
+            self.branches = [Model(inputs=inputs, outputs=output) for output in outputs]
+            for branch in self.branches:
+                compile_model(branch)
+
+        compile_model(self.model)
+
+    def initialize(self):
+        """
+        Gives the model new initial weights, drawn like Keras' default initializers draw them.
+        The optimizer keeps counting its iterations, but the default SGD has no momentum or decay,
+        so the count has no effect and the model is then as good as new.
+        """
+        if self.backend == "numpy":
+            self.model.initialize()
+            return
+
+        for layer in self.model.layers:
+            weights = layer.get_weights()
+            if len(weights) == 2:
+                kernel, bias = weights
+                layer.set_weights([glorot_uniform(self.rng, *kernel.shape, kernel.dtype),
+                                   np.zeros_like(bias)])
+
+    def set_weights(self, weights):
+        """
+        :param weights: The weights of the model as get_weights returns them, or for an ensemble
+        a list of the weights of each branch.
+        """
+        if self.branches is None:
+            self.model.set_weights(weights)
+        else:
+            for branch, branch_weights in zip(self.branches, weights):
+                branch.set_weights(branch_weights)
+
+    def create(self, weights=None):
+        """
+        :param weights: The weights to start from (see set_weights), or None for new initial
+        weights.
+        :return: The model. It is the same model every time, so it must not be used once create is
+        called again.
+        """
+        if self.model is None:
+            self.build()
+        elif weights is None:
+            self.initialize()
+
+        if weights is not None:
+            self.set_weights(weights)
+        return self.model
+
+    def plot(self, filename: str):
+        """
+        Draws a diagram of the model to a file with graphviz. Only Keras models can be drawn.
+        """
+        if self.backend != "keras":
+            raise ValueError("Only Keras models can be drawn")
+
+        from keras.utils import plot_model
+
+        if self.model is None:
+            self.build()
+        plot_model(self.model, to_file=filename, show_shapes=True, show_layer_names=True)
+
+
+# The model factories of this process, by architecture.
+model_factories = {}
+
+
+def model_factory(train_metadata, backend: str = "keras", ensemble_size: int = None):
+    """
+    :return: The ModelFactory of this process for the architecture.
+    """
+    key = (tuple(layer_sizes_of(train_metadata)), backend, ensemble_size)
+    if key not in model_factories:
+        model_factories[key] = ModelFactory(train_metadata, backend, ensemble_size)
+    return model_factories[key]
+
+
+def epoch_budget(adaptive: AdaptiveEpochs, epochs: int = None):
+    """
+    :param epochs: The most epochs to train for, or None for the default.
+    :return: The most epochs to train for.
+    """
+    budget = default_epochs if adaptive is None else adaptive.max_epochs
+    return budget if epochs is None else min(budget, epochs)
+
+
+def keras_fit_arguments(adaptive: AdaptiveEpochs, validation_data, epochs: int = None):
+    """
+    :return: The arguments for Keras' fit which make it train for the epochs adaptive asks for.
+    """
+    if adaptive is None:
+        return {"epochs": epoch_budget(adaptive, epochs)}
+    return {"epochs": epoch_budget(adaptive, epochs), "validation_data": validation_data,
+            "callbacks": adaptive.keras_callbacks()}
+
+
+def train_iteration(train_data, train_labels, train_metadata, backend: str = "keras",
+                    adaptive: AdaptiveEpochs = None, validation_data=None, weights=None,
+                    epochs: int = None):
+    """
+    Trains a model.
+
+    :param train_data: The training data, or a TrainingDataStream or CompactDataFeed to train on
+    batches from. train_labels is ignored for those.
+    :param backend: The backend to train with, "keras" or "numpy" (see NumpyMLP).
+    :param adaptive: How to train until the validation loss plateaus, or None to train for 5
+    epochs.
+    :param validation_data: A tuple of the validation data and labels for adaptive.
+    :param weights: The weights to start from (see ModelFactory.create), or None to start from
+    new initial weights.
+    :param epochs: The most epochs to train for, or None for the default of adaptive.
+    :return: A tuple of the trained model and the number of epochs it was trained for. The model
+    is reused by the next call with the same architecture, so it must be done with by then (see
+    ModelFactory).
+    """
+    model = model_factory(train_metadata, backend).create(weights)
+    is_feed = isinstance(train_data, (TrainingDataStream, CompactDataFeed))
+
+    if backend == "numpy":
+        if adaptive is None:
+            arguments = {"epochs": epoch_budget(adaptive, epochs)}
+        else:
+            arguments = {"epochs": epoch_budget(adaptive, epochs),
+                         "validation_data": validation_data, "tolerance": adaptive.tolerance,
+                         "patience": adaptive.patience}
+
+        if is_feed:
+            history = model.fit(train_data, **arguments)
+        else:
+            history = model.fit(train_data, train_labels, batch_size=32, **arguments)
+        return model, len(history)
+
+    if is_feed:
+        history = model.fit_generator(train_data, steps_per_epoch=train_data.steps_per_epoch,
+                                      **keras_fit_arguments(adaptive, validation_data, epochs))
+    else:
+        history = model.fit(train_data, train_labels, batch_size=32,
+                            **keras_fit_arguments(adaptive, validation_data, epochs))
+    return model, len(history.history["loss"])
+
+
+def repeat_labels(train_data, size: int):
+    for data, labels in train_data:
+        yield data, [labels] * size
+
+
+def train_ensemble_iteration(train_data, train_labels, train_metadata, size: int,
+                             adaptive: AdaptiveEpochs = None, validation_data=None, weights=None,
+                             epochs: int = None):
+    """
+    Trains several models at once, as independently initialized branches of one model which all
+    see the same batches. Each branch has its own loss. The loss of the whole model is their sum,
+    so with plain SGD every branch follows the gradient of its own loss only, exactly like a model
+    trained alone.
+
+    :param train_data: The training data, or a TrainingDataStream or CompactDataFeed to train on
+    batches from. train_labels is ignored for those.
+    :param size: The number of models.
+    :param adaptive: How to train until the validation loss plateaus, or None to train for 5
+    epochs. The validation loss is the sum over all the models, so they all stop together.
+    :param validation_data: A tuple of the validation data and labels for adaptive.
+    :param weights: A list of the weights for each model to start from, or None to start from new
+    initial weights.
+    :param epochs: The most epochs to train for, or None for the default of adaptive.
+    :return: A tuple of the trained models and the number of epochs they were trained for. The
+    models are reused by the next call with the same architecture, so they must be done with by
+    then (see ModelFactory).
+    """
+    factory = model_factory(train_metadata, "keras", size)
+    ensemble = factory.create(weights)
+
+    if validation_data is not None:
+        validation_data = (validation_data[0], [validation_data[1]] * size)
+
+    if isinstance(train_data, (TrainingDataStream, CompactDataFeed)):
+        history = ensemble.fit_generator(repeat_labels(train_data, size),
+                                         steps_per_epoch=train_data.steps_per_epoch,
+                                         **keras_fit_arguments(adaptive, validation_data,
+                                                               epochs))
+    else:
+        history = ensemble.fit(train_data, [train_labels] * size, batch_size=32,
+                               **keras_fit_arguments(adaptive, validation_data, epochs))
+
+    return factory.branches, len(history.history["loss"])
+
+
+def evaluate_model(model, test_data, test_labels, test_metadata):
+    """
+    Tests a trained model.
+
+    :return: A tuple of the loss, the accuracy, the number of jaywalkers and the number of
+    jaywalkers in the chosen option when the model chose wrong.
+    """
     (loss, accuracy) = model.evaluate(test_data, test_labels, batch_size=32)
     print("Loss:")
     print(loss)
@@ -66,113 +405,435 @@ def train_and_test_iteration(train_data, train_labels, train_metadata, test_data
     print("Expected:")
     print(test_labels)
 
-    num_jaywalkers_when_wrong = 0  # number of jaywalkers when the ai classified incorrectly
-    num_jaywalkers = 0  # number of jaywalkers total
-
-    for i in range(len(test_labels)):
-        prediction_label = predictions[i].tolist()
-        test_label = test_labels[i].tolist()
-
-        prediction_index = prediction_label.index(max(prediction_label))
-        test_index = test_label.index(max(test_label))
-
-        dilemma = create_dilemma_from_export(test_data[i].tolist(), 2,
+    jaywalkers = count_jaywalkers_per_option(test_data, 2,
                                              test_metadata.max_num_people_per_option)
 
-        for option in dilemma.options:
-            for person in option:
-                if person.jaywalking:
-                    num_jaywalkers += 1
+    prediction_indices = np.argmax(predictions, axis=1)
+    test_indices = np.argmax(test_labels, axis=1)
+    wrong = prediction_indices != test_indices
+
+    # number of jaywalkers total
+    num_jaywalkers = int(jaywalkers.sum())
 
-        if prediction_index != test_index:
-            for person in dilemma.options[prediction_index]:
-                if person.jaywalking:
-                    num_jaywalkers_when_wrong += 1
+    # number of jaywalkers in the chosen option when the ai classified incorrectly
+    num_jaywalkers_when_wrong = int(jaywalkers[wrong, prediction_indices[wrong]].sum())
 
     return loss, accuracy, num_jaywalkers, num_jaywalkers_when_wrong
 
 
-def train_and_test(test_data_filename: str, option_cpd, jaywalking_cpd):
+def train_and_test_iteration(train_data, train_labels, train_metadata, test_data, test_labels,
+                             test_metadata, backend: str = "keras",
+                             adaptive: AdaptiveEpochs = None):
+    """
+    Trains a model and tests it.
+
+    :param train_data: The training data, or a TrainingDataStream or CompactDataFeed to train on
+    batches from. train_labels is ignored for those.
+    :param backend: The backend to train with (see train_iteration).
+    :param adaptive: How to train until the validation loss plateaus, or None to train for 5
+    epochs. The validation data is held out of the training data.
+    :return: The results of evaluate_model followed by the number of epochs trained for.
+    """
+    validation_data = None
+    if adaptive is not None:
+        if isinstance(train_data, (TrainingDataStream, CompactDataFeed)):
+            validation_data = adaptive.draw(train_data)
+        else:
+            (train_data, train_labels), validation_data = adaptive.split(train_data, train_labels)
+
+    model, epochs = train_iteration(train_data, train_labels, train_metadata, backend, adaptive,
+                                    validation_data)
+    return evaluate_model(model, test_data, test_labels, test_metadata) + (epochs,)
+
+
+def load_test_set(test_data_filename: str):
+    """
+    Reads a test set in the form train_and_test_iteration tests against.
+
+    :param test_data_filename: The prefix of the test set's files.
+    :return: A tuple of the test data, labels and metadata.
+    """
     test_data, test_labels, test_metadata = read_data_from_file(test_data_filename)
-
-    generators = [
-        DilemmaGenerator(
-            option_vals=[
-                [option_cpd[0], option_cpd[1]]
-            ],
-            jaywalking_vals=[
-                [jaywalking_cpd[0], jaywalking_cpd[1]],
-                [jaywalking_cpd[1], jaywalking_cpd[0]]
-            ]
-        ),
-        DilemmaGenerator(
-            option_vals=[
-                [option_cpd[1], option_cpd[0]]
-            ],
-            jaywalking_vals=[
-                [jaywalking_cpd[1], jaywalking_cpd[0]],
-                [jaywalking_cpd[0], jaywalking_cpd[1]]
-            ]
-        )
-    ]
-
-    train_data, train_labels, train_metadata = generate_training_data_in_memory(
-        TrainMetadata(50000, 10),
-        generators
+    if test_data.ndim == 4:
+        # Test data saved in the compact encoding.
+        test_data = compact_to_export(test_data).reshape(len(test_data), -1)
+    return test_data, test_labels, test_metadata
+
+
+def train_and_test(test_data_filename: str, option_cpd, jaywalking_cpd, seed: int = None,
+                   workers: int = 1, stream: bool = False, prefetch: int = 8,
+                   compact: bool = False, symmetric: bool = False, test_set=None,
+                   cache: TrainingDataCache = None, ensemble: bool = False,
+                   backend: str = "keras", plot_filename: str = None,
+                   adaptive: AdaptiveEpochs = None, warm_start: WarmStart = None,
+                   checkpoints: CheckpointStore = None):
+    """
+    Trains models on data generated from the CPDs and tests them (see train_and_test_many).
+
+    :param test_data_filename: The prefix of the test set's files.
+    :param test_set: The test set if it is already loaded (see load_test_set), so it isn't read
+    from test_data_filename again.
+    :return: The results of each repeat.
+    """
+    return train_and_test_many([test_data_filename], option_cpd, jaywalking_cpd, seed=seed,
+                               workers=workers, stream=stream, prefetch=prefetch,
+                               compact=compact, symmetric=symmetric,
+                               test_sets=None if test_set is None else [test_set],
+                               cache=cache, ensemble=ensemble, backend=backend,
+                               plot_filename=plot_filename, adaptive=adaptive,
+                               warm_start=warm_start, checkpoints=checkpoints)[0]
+
+
+def train_and_test_many(test_data_filenames, option_cpd, jaywalking_cpd, seed: int = None,
+                        workers: int = 1, stream: bool = False, prefetch: int = 8,
+                        compact: bool = False, symmetric: bool = False, test_sets=None,
+                        cache: TrainingDataCache = None, ensemble: bool = False,
+                        backend: str = "keras", plot_filename: str = None,
+                        adaptive: AdaptiveEpochs = None, warm_start: WarmStart = None,
+                        checkpoints: CheckpointStore = None):
+    """
+    Trains models on data generated from the CPDs and tests each of them against every test set,
+    so the models don't depend on the test sets and are trained only once for all of them.
+
+    :param test_data_filenames: The prefixes of the test sets' files.
+    :param test_sets: The test sets if they are already loaded (see load_test_set), so they
+    aren't read from test_data_filenames again.
+    :param cache: The cache to reuse training data from, or None to always generate it. Streamed
+    training data is never cached.
+    :param ensemble: Whether to train the models of all repeats at once (see
+    train_ensemble_iteration), on the training data of the first repeat. The numpy backend
+    trains them one after another on that data instead.
+    :param backend: The backend to train with (see train_iteration).
+    :param plot_filename: The file to draw a diagram of the model to, or None to not draw one.
+    :param adaptive: How to train until the validation loss plateaus, or None to train for 5
+    epochs. The same validation data is held out of the training data for every repeat. Streams
+    hold out their first batches instead.
+    :param warm_start: The weights to start each repeat's model from and to keep the final weights
+    in for the next cell, or None to always start from new initial weights.
+    :param checkpoints: The store to save the weights of every model trained in, or None to not
+    save them.
+    :return: The results of each repeat, for each test set. Each result records the number of
+    epochs its model was trained for, how long training took and whether it was warm started.
+    """
+    if backend not in backends:
+        raise ValueError("Unknown backend: " + backend)
+
+    if test_sets is None:
+        test_sets = [load_test_set(test_data_filename)
+                     for test_data_filename in test_data_filenames]
+
+    generator = DilemmaGenerator(
+        option_vals=[
+            [option_cpd[0], option_cpd[1]]
+        ],
+        jaywalking_vals=[
+            [jaywalking_cpd[0], jaywalking_cpd[1]],
+            [jaywalking_cpd[1], jaywalking_cpd[0]]
+        ]
     )
 
-    test_results_json = []
-    for _ in range(5):
-        loss, accuracy, num_jaywalkers, num_jaywalkers_when_wrong = train_and_test_iteration(
-            train_data, train_labels, train_metadata, test_data, test_labels, test_metadata
-        )
-
-        test_results_json.append({
-            "loss": loss,
-            "accuracy": accuracy,
-            "num_jaywalkers": num_jaywalkers,
-            "prob_jaywalking_when_wrong": num_jaywalkers_when_wrong / num_jaywalkers
-        })
-
-    test_data_filename_without_path = test_data_filename[test_data_filename.rfind('/') + 1:]
-    with open("results from iteration for " + test_data_filename_without_path, "a") as f:
-        f.write(json.dumps(
-            test_results_json
-        ) + "\n")
+    # The second generator is the mirror of the first. In symmetric mode its data is derived from
+    # the first generator instead, except for streams which need both generators.
+    generators = [generator]
+    if not symmetric or stream:
+        generators.append(generator.mirror())
+
+    train_metadata = TrainMetadata(50000, 10)
+
+    def generate():
+        return generate_training_data_in_memory(train_metadata, generators, seed=seed,
+                                                workers=workers, compact=compact,
+                                                symmetric=symmetric)
+
+    validation_data = None
+    if not stream:
+        if cache is None:
+            train_set = generate()
+        else:
+            train_set = cache.get_or_generate(
+                TrainingDataCache.key(option_cpd, jaywalking_cpd, train_metadata, seed=seed,
+                                      compact=compact, symmetric=symmetric),
+                generate
+            )
+
+        if compact:
+            # Keep only the compact encoding in memory and expand it one batch at a time.
+            compact_train_data, compact_train_labels, train_metadata = train_set
+        else:
+            train_data, train_labels, train_metadata = train_set
+
+        if adaptive is not None and compact:
+            (compact_train_data, compact_train_labels), (validation_data, validation_labels) = \
+                adaptive.split(compact_train_data, compact_train_labels, seed)
+            validation_data = (
+                compact_to_export(validation_data).reshape(len(validation_data), -1),
+                validation_labels
+            )
+        elif adaptive is not None:
+            (train_data, train_labels), validation_data = adaptive.split(train_data, train_labels,
+                                                                         seed)
+
+    num_repeats = 5
+
+    if plot_filename is not None:
+        model_factory(train_metadata, backend,
+                      num_repeats if ensemble and backend == "keras" else None).plot(plot_filename)
+
+    test_results_json = [[] for _ in test_sets]
+    for repeat in range(1 if ensemble else num_repeats):
+        if stream:
+            # Every repeat trains on its own stream, seeded from the seed and the repeat.
+            train_data = TrainingDataStream(
+                generators,
+                train_metadata.max_num_people_per_option,
+                train_metadata.train_data_size,
+                seed=None if seed is None else np.random.SeedSequence(seed, spawn_key=(repeat,)),
+                prefetch=prefetch
+            )
+            train_labels = None
+        elif compact:
+            train_data = CompactDataFeed(
+                compact_train_data,
+                compact_train_labels,
+                seed=None if seed is None else np.random.SeedSequence(seed, spawn_key=(repeat,))
+            )
+            train_labels = None
+
+        if stream and adaptive is not None:
+            # Streams are endless, so their first batches are held out for validation.
+            validation_data = adaptive.draw(train_data)
+
+        def trained_models():
+            # Models are reused by the next one trained (see ModelFactory), so each one is
+            # trained only after the one before it is tested.
+            if ensemble and backend == "keras":
+                weights = None
+                if warm_start is not None and len(warm_start.weights) == num_repeats:
+                    weights = [warm_start.weights[index] for index in range(num_repeats)]
+
+                start = time.perf_counter()
+                models, epochs = train_ensemble_iteration(
+                    train_data, train_labels, train_metadata, num_repeats, adaptive,
+                    validation_data, weights, None if weights is None else warm_start.epochs
+                )
+                seconds = time.perf_counter() - start
+
+                for index, model in enumerate(models):
+                    yield index, model, epochs, seconds, weights is not None
+            else:
+                for index in range(repeat, repeat + (num_repeats if ensemble else 1)):
+                    weights = None if warm_start is None else warm_start.weights.get(index)
+
+                    start = time.perf_counter()
+                    model, epochs = train_iteration(
+                        train_data, train_labels, train_metadata, backend, adaptive,
+                        validation_data, weights, None if weights is None else warm_start.epochs
+                    )
+                    seconds = time.perf_counter() - start
+
+                    yield index, model, epochs, seconds, weights is not None
+
+        try:
+            for index, model, epochs, seconds, warm in trained_models():
+                if warm_start is not None:
+                    warm_start.weights[index] = model.get_weights()
+                if checkpoints is not None:
+                    checkpoints.save(option_cpd, jaywalking_cpd, index, seed, model.get_weights(),
+                                     backend, None if warm_start is None else warm_start.epochs,
+                                     layer_sizes=layer_sizes_of(train_metadata), epochs=epochs,
+                                     warm_start=warm)
+
+                for results, (test_data, test_labels, test_metadata) in zip(test_results_json,
+                                                                              test_sets):
+                    loss, accuracy, num_jaywalkers, num_jaywalkers_when_wrong = evaluate_model(
+                        model, test_data, test_labels, test_metadata
+                    )
+
+                    results.append({
+                        "loss": loss,
+                        "accuracy": accuracy,
+                        "num_jaywalkers": num_jaywalkers,
+                        "prob_jaywalking_when_wrong": num_jaywalkers_when_wrong / num_jaywalkers,
+                        "epochs": epochs,
+                        "train_seconds": seconds,
+                        "warm_start": warm
+                    })
+        finally:
+            if stream or compact:
+                train_data.close()
+
+    for test_data_filename, results in zip(test_data_filenames, test_results_json):
+        test_data_filename_without_path = test_data_filename[test_data_filename.rfind('/') + 1:]
+        with open("results from iteration for " + test_data_filename_without_path, "a") as f:
+            f.write(json.dumps(
+                results
+            ) + "\n")
+
+    return test_results_json
 
 
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, "o:", ["ocpd=", "jcpd="])
+        opts, args = getopt.getopt(argv, "o:", ["ocpd=", "jcpd=", "seed=", "workers=", "stream",
+                                                "prefetch=", "compact", "symmetric", "cache",
+                                                "ensemble", "backend=", "plot-model=",
+                                                "adaptive", "max-epochs=", "checkpoints="])
     except getopt.GetoptError:
-        print("Usage: train_ai_iteration.py -o <test_file_prefix>")
+        print(usage)
         sys.exit(2)
 
-    test_data_filename = None
+    test_data_filenames = []
     ocpd = None
     jcpd = None
+    seed = None
+    workers = 1
+    stream = False
+    prefetch = 8
+    compact = False
+    symmetric = False
+    cache = None
+    ensemble = False
+    backend = "keras"
+    plot_filename = None
+    adaptive = None
+    max_epochs = None
+    checkpoints = None
     for opt, arg in opts:
         if opt == "-o":
-            test_data_filename = arg
+            # Every test set given is tested against the same models.
+            test_data_filenames.append(arg)
         elif opt == "--ocpd":
             ocpd = float(arg)
         elif opt == "--jcpd":
             jcpd = float(arg)
-
-    if test_data_filename is None:
+        elif opt == "--seed":
+            seed = int(arg)
+        elif opt == "--workers":
+            workers = int(arg)
+        elif opt == "--stream":
+            stream = True
+        elif opt == "--prefetch":
+            prefetch = int(arg)
+        elif opt == "--compact":
+            compact = True
+        elif opt == "--symmetric":
+            symmetric = True
+        elif opt == "--cache":
+            cache = TrainingDataCache()
+        elif opt == "--ensemble":
+            ensemble = True
+        elif opt == "--backend":
+            backend = arg
+        elif opt == "--plot-model":
+            plot_filename = arg
+        elif opt == "--adaptive":
+            adaptive = AdaptiveEpochs()
+        elif opt == "--max-epochs":
+            max_epochs = int(arg)
+        elif opt == "--checkpoints":
+            checkpoints = CheckpointStore(arg)
+
+    if len(test_data_filenames) == 0:
         print("-o argument required")
-        print("Usage: train_ai_iteration.py -o <test_file_prefix>")
+        print(usage)
         sys.exit(2)
     elif ocpd is None:
         print("--ocpd argument required")
-        print("Usage: train_ai_iteration.py --ocpd <first_option_prob>")
+        print(usage)
         sys.exit(2)
     elif jcpd is None:
         print("--jcpd argument required")
-        print("Usage: train_ai_iteration.py --jcpd <jaywalking_prob>")
+        print(usage)
+        sys.exit(2)
+    elif max_epochs is not None and adaptive is None:
+        print("--max-epochs requires --adaptive")
+        print(usage)
         sys.exit(2)
 
-    train_and_test(test_data_filename, [ocpd, 1 - ocpd], [jcpd, 1 - jcpd])
+    if max_epochs is not None:
+        adaptive.max_epochs = max_epochs
+
+    train_and_test_many(test_data_filenames, [ocpd, 1 - ocpd], [jcpd, 1 - jcpd], seed=seed,
+                        workers=workers, stream=stream, prefetch=prefetch, compact=compact,
+                        symmetric=symmetric, cache=cache, ensemble=ensemble,
+                        backend=backend, plot_filename=plot_filename, adaptive=adaptive,
+                        checkpoints=checkpoints)
+
+
+class TestModelFactory(unittest.TestCase):
+
+    def testCreateReusesModel(self):
+        factory = ModelFactory(TrainMetadata(10, 3), "numpy")
+
+        model = factory.create()
+        weights = model.get_weights()
+        other = factory.create()
+
+        # The same model with new initial weights.
+        self.assertIs(other, model)
+        self.assertFalse(np.array_equal(other.get_weights()[0], weights[0]))
+        self.assertTrue(all(np.array_equal(new, old)
+                            for new, old in zip(other.get_weights()[1::2], weights[1::2])))
+
+        self.assertIs(factory.create(weights), model)
+        self.assertTrue(all(np.array_equal(new, old)
+                            for new, old in zip(model.get_weights(), weights)))
+
+    def testOneFactoryPerArchitecture(self):
+        self.assertIs(model_factory(TrainMetadata(10, 3), "numpy"),
+                      model_factory(TrainMetadata(20, 3), "numpy"))
+        self.assertIsNot(model_factory(TrainMetadata(10, 3), "numpy"),
+                         model_factory(TrainMetadata(10, 4), "numpy"))
+
+
+class TestAdaptiveEpochs(unittest.TestCase):
+
+    def testSplit(self):
+        data = np.arange(200).reshape(100, 2)
+        labels = np.arange(100)
+        adaptive = AdaptiveEpochs(validation_fraction=0.1)
+
+        (train_data, train_labels), (validation_data, validation_labels) = adaptive.split(
+            data, labels, seed=1)
+
+        self.assertEqual(len(validation_data), 10)
+        self.assertEqual(len(train_data), 90)
+        self.assertTrue(np.array_equal(train_data[:, 0] // 2, train_labels))
+        self.assertTrue(np.array_equal(validation_data[:, 0] // 2, validation_labels))
+        self.assertEqual(sorted(np.concatenate([train_labels, validation_labels])), list(labels))
+
+        other_validation_labels = adaptive.split(data, labels, seed=1)[1][1]
+        self.assertTrue(np.array_equal(validation_labels, other_validation_labels))
+
+    def testDraw(self):
+        data = np.zeros((100, 2, 3, 5), dtype=np.uint8)
+        labels = np.eye(2, dtype=np.uint8)[np.arange(100) % 2]
+        feed = CompactDataFeed(data, labels, batch_size=10, seed=1)
+
+        validation_data, validation_labels = AdaptiveEpochs(validation_fraction=0.2).draw(feed)
+
+        # 20% of the 10 steps of an epoch.
+        self.assertEqual(validation_data.shape, (20, 2 * 3 * 22))
+        self.assertEqual(validation_labels.shape, (20, 2))
+
+    def testEpochBudget(self):
+        self.assertEqual(epoch_budget(None), default_epochs)
+        self.assertEqual(epoch_budget(AdaptiveEpochs()), default_epochs)
+        self.assertEqual(epoch_budget(AdaptiveEpochs(max_epochs=8), 2), 2)
+
+    def testTrainsWithNumpyBackend(self):
+        generators = [DilemmaGenerator(option_vals=[[0.4, 0.6]], cache=None)]
+        data, labels, metadata = generate_training_data_in_memory(TrainMetadata(600, 3),
+                                                                  generators, seed=1)
+
+        loss, accuracy, num_jaywalkers, num_jaywalkers_when_wrong, epochs = \
+            train_and_test_iteration(data[:500], labels[:500], metadata, data[500:],
+                                     labels[500:], metadata, backend="numpy",
+                                     adaptive=AdaptiveEpochs(max_epochs=3))
+
+        self.assertLessEqual(epochs, 3)
+        self.assertGreater(accuracy, 0.5)
+        self.assertLessEqual(num_jaywalkers_when_wrong, num_jaywalkers)
 
 
 if __name__ == '__main__':